@@ -0,0 +1,228 @@
+"""
+ JSON-RPC Benchmarks
+
+"""
+
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import functions
+from client import JSONRPCClient, PipelinedJSONRPCClient
+from codec import CODECS
+from server import JSONRPCServer
+
+
+# Define server host and port
+SERVER_HOST = '127.0.0.1'
+SERVER_PORT = 8001
+
+# The math functions and the parameters they are called with
+MATH_FUNCTIONS = {
+    'add': (4, 2),
+    'sub': (4, 2),
+    'mul': (4, 2),
+    'div': (4, 2),
+    'fib': (22,)
+}
+
+
+def start_server(server):
+    """Starts a server in a thread and waits for it to listen."""
+    thread = threading.Thread(target=server.start)
+    thread.start()
+    while True:
+        try:
+            socket.create_connection((server.host, server.port)).close()
+            return thread
+        except ConnectionRefusedError:
+            time.sleep(0.01)
+
+
+def stop_server(server, thread):
+    """Stops a server started by start_server."""
+    server.stop()
+    thread.join()
+
+
+def run_calls(client, method, params, calls, concurrency):
+    """Makes calls from several threads and returns the calls per second."""
+    def worker(count):
+        for _ in range(count):
+            client.invoke(method, params)
+
+    # Warm up, process workers are only started on the first call
+    client.invoke(method, params)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        for _ in executor.map(worker, [calls // concurrency] * concurrency):
+            pass
+    return calls / (time.perf_counter() - start)
+
+
+def bench_executors(calls=400, concurrency=16):
+    """Compares the executors for the math functions."""
+    cores = os.cpu_count() or 1
+    modes = [('inline', None), ('thread', cores)]
+    workers = 1
+    while workers <= cores:
+        modes.append(('process', workers))
+        workers *= 2
+
+    print('%-8s %-8s %-8s %12s' % ('method', 'executor', 'workers', 'calls/s'))
+    for executor, workers in modes:
+        server = JSONRPCServer(SERVER_HOST, SERVER_PORT, verbose=False)
+        if executor != 'inline':
+            server.configure_executor(executor, workers=workers)
+        for name in MATH_FUNCTIONS:
+            server.register(name, getattr(functions, name), executor=executor)
+        thread = start_server(server)
+
+        client = PipelinedJSONRPCClient(SERVER_HOST, SERVER_PORT)
+        for name, params in MATH_FUNCTIONS.items():
+            rate = run_calls(client, name, params, calls, concurrency)
+            print('%-8s %-8s %-8s %12.0f' % (name, executor, workers or '-', rate))
+        client.close()
+
+        stop_server(server, thread)
+
+
+def bench_map(pairs=20000):
+    """Compares rpc.map against one call per pair."""
+    server = JSONRPCServer(SERVER_HOST, SERVER_PORT, verbose=False)
+    for name in MATH_FUNCTIONS:
+        server.register(name, getattr(functions, name))
+    thread = start_server(server)
+    client = JSONRPCClient(SERVER_HOST, SERVER_PORT)
+
+    rows = [[num, num + 1] for num in range(pairs)]
+    columns = [list(column) for column in zip(*rows)]
+    modes = {
+        'per call': lambda: [client.add(*row) for row in rows],
+        'map rows': lambda: client.invoke_map('add', rows),
+        'map columns': lambda: client.invoke_map('add', columns, columnar=True)
+    }
+
+    print('%-12s %10s %12s' % ('mode', 'seconds', 'pairs/s'))
+    for mode, run in modes.items():
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+        print('%-12s %10.3f %12.0f' % (mode, elapsed, pairs / elapsed))
+
+    client.close()
+    stop_server(server, thread)
+
+
+def register_math(server):
+    """Registers the math functions, in every worker of a pre-fork server."""
+    for name in MATH_FUNCTIONS:
+        server.register(name, getattr(functions, name))
+
+
+def call_many(method, params, calls):
+    """Makes calls on a connection of its own, in a client process."""
+    client = JSONRPCClient(SERVER_HOST, SERVER_PORT)
+    for _ in range(calls):
+        client.invoke(method, params)
+    client.close()
+
+
+def bench_workers(calls=4000, clients=None):
+    """Measures how the pre-fork server scales with the number of workers."""
+    cores = os.cpu_count() or 1
+    clients = clients or 2 * cores
+
+    print('%-8s %-8s %12s' % ('method', 'workers', 'calls/s'))
+    workers = 1
+    while workers <= cores:
+        server = JSONRPCServer(SERVER_HOST, SERVER_PORT, verbose=False)
+        thread = threading.Thread(target=server.serve_forever,
+                                  kwargs={'workers': workers, 'setup': register_math})
+        thread.start()
+        server.ready.wait()
+
+        # Clients run in processes of their own so they are not the bottleneck
+        with ProcessPoolExecutor(clients) as executor:
+            for name, params in MATH_FUNCTIONS.items():
+                start = time.perf_counter()
+                for _ in executor.map(call_many, [name] * clients, [params] * clients,
+                                      [calls // clients] * clients):
+                    pass
+                rate = calls / (time.perf_counter() - start)
+                print('%-8s %-8s %12.0f' % (name, workers, rate))
+
+        stop_server(server, thread)
+        workers *= 2
+
+
+def bench_stats(calls=4000, concurrency=16):
+    """Measures the cost of the call statistics."""
+    print('%-8s %12s' % ('stats', 'calls/s'))
+    for stats in (False, True):
+        server = JSONRPCServer(SERVER_HOST, SERVER_PORT, verbose=False, stats=stats)
+        server.register('add', functions.add)
+        thread = start_server(server)
+
+        client = PipelinedJSONRPCClient(SERVER_HOST, SERVER_PORT)
+        rate = run_calls(client, 'add', (4, 2), calls, concurrency)
+        print('%-8s %12.0f' % ('on' if stats else 'off', rate))
+        client.close()
+
+        stop_server(server, thread)
+
+
+def bench_codecs(pairs=20000, rounds=20):
+    """Compares the codecs in encode/decode speed and bytes on the wire."""
+    columns = [list(range(pairs)), [num / 3 for num in range(pairs)]]
+    payloads = {
+        'call': {'jsonrpc': '2.0', 'id': 1, 'method': 'greet', 'params': ['bob']},
+        'map columns': {'jsonrpc': '2.0', 'id': 1, 'method': 'rpc.map',
+                        'params': ['add', columns, True]},
+        'map result': {'jsonrpc': '2.0', 'id': 1,
+                       'result': [num * 1.5 for num in range(pairs)]}
+    }
+
+    print('%-12s %-8s %10s %12s %12s' % ('payload', 'codec', 'bytes', 'encode MB/s', 'decode MB/s'))
+    for name, payload in payloads.items():
+        for codec in CODECS.values():
+            data = codec.frame(codec.dumps(payload))
+
+            start = time.perf_counter()
+            for _ in range(rounds):
+                codec.dumps(payload)
+            encode = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for _ in range(rounds):
+                codec.loads(codec.dumps(payload))
+            decode = time.perf_counter() - start - encode
+
+            size = len(data) * rounds / 1e6
+            print('%-12s %-8s %10d %12.1f %12.1f' % (
+                name, codec.name, len(data), size / encode, size / max(decode, 1e-9)))
+
+    # End to end, the same rpc.map call over each codec
+    server = JSONRPCServer(SERVER_HOST, SERVER_PORT, verbose=False)
+    server.register('add', functions.add)
+    thread = start_server(server)
+    print('%-8s %10s' % ('codec', 'seconds'))
+    for codec in CODECS:
+        client = JSONRPCClient(SERVER_HOST, SERVER_PORT, codec=codec)
+        start = time.perf_counter()
+        for _ in range(rounds):
+            client.invoke_map('add', columns, columnar=True)
+        print('%-8s %10.3f' % (codec, time.perf_counter() - start))
+        client.close()
+    stop_server(server, thread)
+
+
+if __name__ == "__main__":
+    bench_executors()
+    bench_map()
+    bench_stats()
+    bench_codecs()
+    bench_workers()
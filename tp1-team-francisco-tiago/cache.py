@@ -0,0 +1,72 @@
+"""
+ Result cache for pure functions
+
+"""
+
+import json
+import time
+from collections import OrderedDict
+
+
+# Returned by LRU.get when the key is not cached
+MISSING = object()
+
+
+class LRU:
+    """Least recently used cache, with an optional time to live in seconds."""
+
+    def __init__(self, maxsize=128, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+        self.collapsed = 0
+
+    def get(self, key):
+        """Returns the cached value or MISSING."""
+        try:
+            value, expires = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return MISSING
+
+        if expires is not None and expires <= time.monotonic():
+            del self.entries[key]
+            self.expired += 1
+            self.misses += 1
+            return MISSING
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """Caches a value, evicting the least recently used one if full."""
+        expires = None
+        if self.ttl is not None:
+            expires = time.monotonic() + self.ttl
+
+        self.entries[key] = (value, expires)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        """Returns the cache counters."""
+        return {
+            'size': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expired': self.expired,
+            'collapsed': self.collapsed
+        }
+
+
+def cache_key(method, params):
+    """Builds the cache key of a call from its canonical params."""
+    return method + ':' + json.dumps(params, sort_keys=True, separators=(',', ':'))
@@ -3,32 +3,411 @@
 
 """
 
+import asyncio
 import json
 import socket
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import Future
+from codec import CODECS, JSONCodec
+from framing import FrameReader, encode_frame
+from transport import connect, local_name, unix_path
 
 
 class JSONRPCClient:
-    """The JSON-RPC client."""
+    """
+    The JSON-RPC client.
 
-    def __init__(self, host, port):
-        self.sock = socket.socket()
-        self.sock.connect((host, port))
+    With codec='binary' the client asks the server to switch the connection
+    to the binary codec, and keeps JSON if the server does not support it.
+    The host may be 'unix:///path' or 'inproc://name', see transport.py.
+    """
+
+    def __init__(self, host, port, codec='json'):
+        if codec not in CODECS:
+            raise ValueError('Unknown codec %r' % codec)
+        self.sock = connect(host, port)
+        self.codec = JSONCodec
+        self.reader = JSONCodec.reader()
+        self.frames = deque()
+        self.lock = threading.Lock()
         self._id = 0
+        if codec != JSONCodec.name:
+            self.negotiate(codec)
+
+    def negotiate(self, name):
+        """Switches the connection to a codec if the server supports it."""
+        try:
+            name = self.invoke('rpc.negotiate', [name])
+        except AttributeError:
+            # Server without codec negotiation
+            return
+        with self.lock:
+            self.codec = CODECS[name]
+            self.reader = self.codec.reader()
 
     def close(self):
         """Closes the connection."""
         self.sock.close()
 
-    def send(self, msg):
-        """Sends a message to the server."""
-        self.sock.sendall(msg.encode())
-        return self.sock.recv(1024).decode()
+    def is_alive(self):
+        """Checks, without blocking, that the server did not close the connection."""
+        if self.frames:
+            return True
+        try:
+            self.sock.setblocking(False)
+            try:
+                return self.sock.recv(1, socket.MSG_PEEK) != b''
+            finally:
+                self.sock.setblocking(True)
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+
+    def send(self, req):
+        """Sends a message to the server and returns the answer, one exchange at a time."""
+        with self.lock:
+            self.sock.sendall(self.codec.frame(self.codec.dumps(req)))
+            return self.codec.loads(self.recv())
+
+    def next_id(self):
+        """Returns a new request id."""
+        with self.lock:
+            self._id += 1
+            return self._id
+
+    def recv(self):
+        """Receives the next message from the server."""
+        while not self.frames:
+            data = self.sock.recv(65536)
+            if not data:
+                raise ConnectionError('Connection closed by the server')
+            self.frames.extend(self.reader.feed(data))
+        return self.frames.popleft()
 
     def invoke(self, method, params):
         """Invokes a remote function."""
         #req = {
          #   'Hello': 'World'
         #}
+        req = {
+            'jsonrpc': '2.0',
+            'id': self.next_id(),
+            'method': method,
+            'params': params
+        }
+        return get_result(self.send(req))
+
+    def invoke_stream(self, method, params):
+        """
+        Invokes a remote function and iterates over the items of its result
+        as the server streams them.
+
+        The connection is held until the iteration ends. A result that is
+        not streamed is iterated if it is a list, and given as the single
+        item otherwise.
+        """
+        req = {
+            'jsonrpc': '2.0',
+            'id': self.next_id(),
+            'method': method,
+            'params': params,
+            'stream': True
+        }
+        with self.lock:
+            self.sock.sendall(self.codec.frame(self.codec.dumps(req)))
+            res = {}
+            try:
+                res = self.codec.loads(self.recv())
+                while 'partial' in res:
+                    yield from res['partial']
+                    res = self.codec.loads(self.recv())
+
+                result = get_result(res)
+                if not res.get('done'):
+                    if isinstance(result, list):
+                        yield from result
+                    else:
+                        yield result
+            finally:
+                # Skip the rest of a stream that was not read to the end
+                while 'partial' in res:
+                    res = self.codec.loads(self.recv())
+
+    def invoke_batch(self, calls):
+        """Invokes several remote functions in a single round trip."""
+        reqs = []
+        futures = {}
+        for method, params, future in calls:
+            rpcid = self.next_id()
+            reqs.append({
+                'jsonrpc': '2.0',
+                'id': rpcid,
+                'method': method,
+                'params': params
+            })
+            futures[rpcid] = future
+
+        responses = self.send(reqs)
+        if isinstance(responses, dict):
+            # The whole batch was rejected
+            for future in futures.values():
+                future.set_exception(get_error(responses))
+            return
+
+        for res in responses:
+            future = futures.pop(res['id'], None)
+            if future is None:
+                continue
+            try:
+                future.set_result(get_result(res))
+            except Exception as error:
+                future.set_exception(error)
+
+        for future in futures.values():
+            future.set_exception(RuntimeError('No response from the server'))
+
+    def invoke_map(self, method, args, columnar=False):
+        """Applies a remote function to many argument tuples in one call."""
+        return self.invoke('rpc.map', [method, args, columnar])
+
+    def batch(self):
+        """Returns a context that sends the calls made inside it as a batch."""
+        return Batch(self)
+
+    def __getattr__(self, name):
+        """Invokes a generic function."""
+        def inner(*params):
+            return self.invoke(name, params)
+        return inner
+
+
+class JSONRPCClientPool:
+    """
+    Thread-safe pool of JSONRPCClient connections.
+
+    Keeps between min_size and max_size connections. Connections idle for
+    longer than idle_check seconds are checked before being lent, and a
+    call that fails because the connection was lost is retried once on a
+    new connection.
+    """
+
+    def __init__(self, host, port, min_size=1, max_size=10, idle_check=30.0):
+        self.host = host
+        self.port = port
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_check = idle_check
+        self.idle = deque()
+        self.size = 0
+        self.cond = threading.Condition()
+
+        # Metrics
+        self.acquires = 0
+        self.waits = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.reconnects = 0
+
+        for _ in range(min_size):
+            self.idle.append((JSONRPCClient(host, port), time.monotonic()))
+            self.size += 1
+
+    def acquire(self, timeout=None):
+        """Lends a connection, waiting up to timeout seconds for a free one."""
+        start = time.monotonic()
+        client = None
+        waited = False
+        with self.cond:
+            while not self.idle and self.size >= self.max_size:
+                waited = True
+                remaining = None
+                if timeout is not None:
+                    remaining = timeout - (time.monotonic() - start)
+                if not self.cond.wait(remaining) and not self.idle \
+                        and self.size >= self.max_size:
+                    raise TimeoutError('No connection available')
+
+            if self.idle:
+                client, last_used = self.idle.pop()
+            else:
+                self.size += 1
+
+            wait_time = time.monotonic() - start
+            self.acquires += 1
+            self.waits += waited
+            self.wait_total += wait_time
+            self.wait_max = max(self.wait_max, wait_time)
+
+        if client is not None:
+            if time.monotonic() - last_used < self.idle_check or client.is_alive():
+                return client
+            client.close()
+            with self.cond:
+                self.reconnects += 1
+
+        try:
+            return JSONRPCClient(self.host, self.port)
+        except OSError:
+            self.discard()
+            raise
+
+    def release(self, client):
+        """Returns a connection to the pool."""
+        with self.cond:
+            self.idle.append((client, time.monotonic()))
+            self.cond.notify()
+
+    def discard(self, client=None):
+        """Drops a broken connection from the pool."""
+        if client is not None:
+            client.close()
+        with self.cond:
+            self.size -= 1
+            self.cond.notify()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """Context that lends a connection."""
+        client = self.acquire(timeout)
+        try:
+            yield client
+        except (ConnectionError, OSError):
+            self.discard(client)
+            raise
+        else:
+            self.release(client)
+
+    def invoke(self, method, params):
+        """Invokes a remote function on a pooled connection."""
+        try:
+            with self.connection() as client:
+                return client.invoke(method, params)
+        except (ConnectionError, OSError):
+            with self.cond:
+                self.reconnects += 1
+            with self.connection() as client:
+                return client.invoke(method, params)
+
+    def stats(self):
+        """Returns the pool metrics."""
+        with self.cond:
+            return {
+                'size': self.size,
+                'idle': len(self.idle),
+                'in_use': self.size - len(self.idle),
+                'acquires': self.acquires,
+                'waits': self.waits,
+                'wait_total': self.wait_total,
+                'wait_avg': self.wait_total / self.acquires if self.acquires else 0.0,
+                'wait_max': self.wait_max,
+                'reconnects': self.reconnects
+            }
+
+    def close(self):
+        """Closes the idle connections."""
+        with self.cond:
+            while self.idle:
+                client, _ = self.idle.pop()
+                client.close()
+                self.size -= 1
+
+    def __getattr__(self, name):
+        """Invokes a generic function."""
+        def inner(*params):
+            return self.invoke(name, params)
+        return inner
+
+
+class Batch:
+    """Collects calls to be sent in a single batch request."""
+
+    def __init__(self, client):
+        self.client = client
+        self.calls = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None and self.calls:
+            self.client.invoke_batch(self.calls)
+
+    def results(self):
+        """Returns the results of the calls, in the order they were made."""
+        return [future.result() for _, _, future in self.calls]
+
+    def __getattr__(self, name):
+        """Queues a generic function and returns the future of its result."""
+        def inner(*params):
+            future = Future()
+            self.calls.append((name, params, future))
+            return future
+        return inner
+
+
+class ClientProtocol(asyncio.Protocol):
+    """Receives the responses of an AsyncJSONRPCClient."""
+
+    def __init__(self, client):
+        self.client = client
+        self.reader = FrameReader()
+
+    def data_received(self, data):
+        for msg in self.reader.feed(data):
+            self.client.handle_response(json.loads(msg))
+
+    def connection_lost(self, exc):
+        self.client.handle_disconnect()
+
+
+class AsyncJSONRPCClient:
+    """
+    The asynchronous JSON-RPC client.
+
+    Requests are written as soon as they are made, so many of them can be
+    in flight on the same connection. Responses are matched by id and may
+    arrive in any order.
+    """
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.transport = None
+        self.loop = None
+        self.closed = False
+        self.pending = {}
+        self._id = 0
+
+    async def connect(self):
+        """Opens the connection, over TCP or a Unix domain socket."""
+        if local_name(self.host) is not None:
+            raise ValueError('In-process connections need JSONRPCClient')
+        self.loop = asyncio.get_running_loop()
+        path = unix_path(self.host)
+        if path is not None:
+            self.transport, _ = await self.loop.create_unix_connection(
+                lambda: ClientProtocol(self), path)
+        else:
+            self.transport, _ = await self.loop.create_connection(
+                lambda: ClientProtocol(self), self.host, self.port)
+
+    async def close(self):
+        """Closes the connection."""
+        self.transport.close()
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    def invoke(self, method, params):
+        """Invokes a remote function and returns a future of its result."""
         self._id += 1
         req = {
             'jsonrpc': '2.0',
@@ -36,16 +415,88 @@ class JSONRPCClient:
             'method': method,
             'params': params
         }
-        msg = self.send(json.dumps(req))
-        res = json.loads(msg)
+        future = self.loop.create_future()
+        if self.closed or self.transport.is_closing():
+            future.set_exception(ConnectionError('Connection closed'))
+            return future
+
+        self.pending[self._id] = future
+        self.transport.write(encode_frame(json.dumps(req)))
+        return future
+
+    def handle_response(self, res):
+        """Resolves the future waiting for a response."""
+        if isinstance(res, list):
+            for item in res:
+                self.handle_response(item)
+            return
+
+        future = self.pending.pop(res.get('id'), None)
+        if future is None or future.done():
+            return
         try:
-            return res['result']
-        except KeyError:
-            if res['error']['code'] == -32601:
-                raise AttributeError
-            if res['error']['code'] == -32602:
-                raise TypeError
-        return res['result']
+            future.set_result(get_result(res))
+        except Exception as error:
+            future.set_exception(error)
+
+    def handle_disconnect(self):
+        """Fails every request still waiting for a response."""
+        self.closed = True
+        pending = self.pending
+        self.pending = {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError('Connection closed by the server'))
+
+    def __getattr__(self, name):
+        """Invokes a generic function, returns an awaitable."""
+        def inner(*params):
+            return self.invoke(name, params)
+        return inner
+
+
+class PipelinedJSONRPCClient:
+    """
+    Thread-safe blocking facade over AsyncJSONRPCClient.
+
+    The connection is driven by an event loop in a background thread, so
+    calls made from several threads share it and are pipelined.
+    """
+
+    def __init__(self, host, port):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.client = AsyncJSONRPCClient(host, port)
+        asyncio.run_coroutine_threadsafe(self.client.connect(), self.loop).result()
+
+    def close(self):
+        """Closes the connection and stops the event loop."""
+        asyncio.run_coroutine_threadsafe(self.client.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def submit(self, method, params):
+        """Sends a request and returns a future of its result."""
+        future = Future()
+        self.loop.call_soon_threadsafe(self.start_call, method, params, future)
+        return future
+
+    def start_call(self, method, params, future):
+        """Starts a call inside the event loop."""
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            call = self.client.invoke(method, params)
+        except Exception as error:
+            future.set_exception(error)
+            return
+        call.add_done_callback(lambda call: copy_result(call, future))
+
+    def invoke(self, method, params):
+        """Invokes a remote function."""
+        return self.submit(method, params).result()
 
     def __getattr__(self, name):
         """Invokes a generic function."""
@@ -54,6 +505,34 @@ class JSONRPCClient:
         return inner
 
 
+def copy_result(source, target):
+    """Copies the outcome of an asyncio future to another future."""
+    if source.cancelled():
+        target.set_exception(asyncio.CancelledError())
+    elif source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+
+def get_error(res):
+    """Returns the exception for an error response."""
+    error = res['error']
+    if error['code'] == -32601:
+        return AttributeError(error['message'])
+    if error['code'] == -32602:
+        return TypeError(error['message'])
+    return RuntimeError(error['message'])
+
+
+def get_result(res):
+    """Returns the result of a response or raises its error."""
+    try:
+        return res['result']
+    except KeyError:
+        raise get_error(res) from None
+
+
 if __name__ == "__main__":
 
     # Test the JSONRPCClient class
@@ -0,0 +1,208 @@
+"""
+ Codecs for the JSON-RPC transport
+
+"""
+
+import json
+import struct
+
+from framing import DELIMITER, FrameReader, LengthFrameReader, encode_length_frame
+
+
+# Type tags of the binary encoding
+NONE = b'N'
+TRUE = b'T'
+FALSE = b'F'
+INT = b'i'
+BIGINT = b'I'
+FLOAT = b'd'
+STR = b's'
+LIST = b'l'
+DICT = b'm'
+INT_ARRAY = b'q'
+FLOAT_ARRAY = b'D'
+
+INT64_MIN = -2 ** 63
+INT64_MAX = 2 ** 63 - 1
+
+PACK_INT = struct.Struct('>q').pack
+PACK_FLOAT = struct.Struct('>d').pack
+PACK_SIZE = struct.Struct('>I').pack
+UNPACK_INT = struct.Struct('>q').unpack_from
+UNPACK_FLOAT = struct.Struct('>d').unpack_from
+UNPACK_SIZE = struct.Struct('>I').unpack_from
+
+
+def encode_value(value, out):
+    """Appends the binary encoding of a value to a bytearray."""
+    kind = type(value)
+    if kind is str:
+        data = value.encode()
+        out += STR
+        out += PACK_SIZE(len(data))
+        out += data
+    elif kind is int:
+        if INT64_MIN <= value <= INT64_MAX:
+            out += INT
+            out += PACK_INT(value)
+        else:
+            data = str(value).encode()
+            out += BIGINT
+            out += PACK_SIZE(len(data))
+            out += data
+    elif kind is float:
+        out += FLOAT
+        out += PACK_FLOAT(value)
+    elif value is None:
+        out += NONE
+    elif value is True:
+        out += TRUE
+    elif value is False:
+        out += FALSE
+    elif kind is dict:
+        out += DICT
+        out += PACK_SIZE(len(value))
+        for key, item in value.items():
+            if type(key) is not str:
+                raise TypeError('Keys must be str, not %s' % type(key).__name__)
+            encode_value(key, out)
+            encode_value(item, out)
+    elif kind is list or kind is tuple:
+        encode_sequence(value, out)
+    else:
+        raise TypeError('Object of type %s cannot be encoded' % kind.__name__)
+
+
+def encode_sequence(values, out):
+    """Appends a list, packing it as a typed array when it is all numbers."""
+    count = len(values)
+    if count > 1:
+        kinds = set(map(type, values))
+        if kinds == {float}:
+            out += FLOAT_ARRAY
+            out += PACK_SIZE(count)
+            out += struct.pack('>%dd' % count, *values)
+            return
+        if kinds == {int} and INT64_MIN <= min(values) and max(values) <= INT64_MAX:
+            out += INT_ARRAY
+            out += PACK_SIZE(count)
+            out += struct.pack('>%dq' % count, *values)
+            return
+
+    out += LIST
+    out += PACK_SIZE(count)
+    for item in values:
+        encode_value(item, out)
+
+
+def decode_value(data, pos):
+    """Decodes the value at a position, returns it and the next position."""
+    tag = data[pos:pos + 1]
+    pos += 1
+    if tag == STR:
+        size = UNPACK_SIZE(data, pos)[0]
+        pos += 4
+        return str(data[pos:pos + size], 'utf-8'), pos + size
+    if tag == INT:
+        return UNPACK_INT(data, pos)[0], pos + 8
+    if tag == FLOAT:
+        return UNPACK_FLOAT(data, pos)[0], pos + 8
+    if tag == NONE:
+        return None, pos
+    if tag == TRUE:
+        return True, pos
+    if tag == FALSE:
+        return False, pos
+    if tag == DICT:
+        count = UNPACK_SIZE(data, pos)[0]
+        pos += 4
+        value = {}
+        for _ in range(count):
+            key, pos = decode_value(data, pos)
+            value[key], pos = decode_value(data, pos)
+        return value, pos
+    if tag == LIST:
+        count = UNPACK_SIZE(data, pos)[0]
+        pos += 4
+        value = []
+        for _ in range(count):
+            item, pos = decode_value(data, pos)
+            value.append(item)
+        return value, pos
+    if tag == FLOAT_ARRAY or tag == INT_ARRAY:
+        count = UNPACK_SIZE(data, pos)[0]
+        pos += 4
+        fmt = '>%d%s' % (count, 'd' if tag == FLOAT_ARRAY else 'q')
+        return list(struct.unpack_from(fmt, data, pos)), pos + 8 * count
+    if tag == BIGINT:
+        size = UNPACK_SIZE(data, pos)[0]
+        pos += 4
+        return int(str(data[pos:pos + size], 'ascii')), pos + size
+    raise ValueError('Unknown type tag %r' % tag)
+
+
+class JSONCodec:
+    """JSON messages, one per line."""
+
+    name = 'json'
+
+    @staticmethod
+    def dumps(obj):
+        """Encodes a message."""
+        return json.dumps(obj).encode()
+
+    @staticmethod
+    def loads(payload):
+        """Decodes a message, raises ValueError if it is invalid."""
+        return json.loads(payload)
+
+    @staticmethod
+    def frame(payload):
+        """Frames an encoded message."""
+        return payload + DELIMITER
+
+    @staticmethod
+    def reader(max_size=None):
+        """Returns a reader for a stream of messages."""
+        return FrameReader(max_size)
+
+
+class BinaryCodec:
+    """Typed binary messages, prefixed with their length."""
+
+    name = 'binary'
+
+    @staticmethod
+    def dumps(obj):
+        """Encodes a message."""
+        out = bytearray()
+        encode_value(obj, out)
+        return bytes(out)
+
+    @staticmethod
+    def loads(payload):
+        """Decodes a message, raises ValueError if it is invalid."""
+        try:
+            value, pos = decode_value(payload, 0)
+        except (struct.error, UnicodeDecodeError) as error:
+            raise ValueError(str(error)) from None
+        if pos != len(payload):
+            raise ValueError('Extra data')
+        return value
+
+    @staticmethod
+    def frame(payload):
+        """Frames an encoded message."""
+        return encode_length_frame(payload)
+
+    @staticmethod
+    def reader(max_size=None):
+        """Returns a reader for a stream of messages."""
+        return LengthFrameReader(max_size)
+
+
+# Codecs by name, in order of preference
+CODECS = {
+    'binary': BinaryCodec,
+    'json': JSONCodec
+}
@@ -0,0 +1,79 @@
+"""
+ Newline-delimited framing for the JSON-RPC transport
+
+"""
+
+# JSON never contains a raw newline, so it can end every message
+DELIMITER = b'\n'
+
+
+def encode_frame(msg):
+    """Frames a message to be sent."""
+    return msg.encode() + DELIMITER
+
+
+class FrameReader:
+    """
+    Splits a byte stream into complete messages.
+
+    Messages are returned as bytes, decoding is left to the receiver. When
+    max_size is set and an unfinished message grows beyond it, the buffer
+    is dropped and overflow is set.
+    """
+
+    def __init__(self, max_size=None):
+        self.buffer = bytearray()
+        self.max_size = max_size
+        self.overflow = False
+
+    def feed(self, data):
+        """Adds received data and returns the complete messages."""
+        self.buffer += data
+        end = self.buffer.rfind(DELIMITER)
+        frames = []
+        if end >= 0:
+            frames = [bytes(frame) for frame in self.buffer[:end].split(DELIMITER)
+                      if frame.strip()]
+            del self.buffer[:end + 1]
+
+        if self.max_size is not None and len(self.buffer) > self.max_size:
+            self.buffer.clear()
+            self.overflow = True
+        return frames
+
+
+class LengthFrameReader:
+    """
+    Splits a byte stream of length-prefixed messages.
+
+    Every message starts with its length as a 4-byte big-endian integer.
+    """
+
+    def __init__(self, max_size=None):
+        self.buffer = bytearray()
+        self.max_size = max_size
+        self.overflow = False
+
+    def feed(self, data):
+        """Adds received data and returns the complete messages."""
+        self.buffer += data
+        frames = []
+        start = 0
+        while len(self.buffer) - start >= 4:
+            size = int.from_bytes(self.buffer[start:start + 4], 'big')
+            if self.max_size is not None and size > self.max_size:
+                self.buffer.clear()
+                self.overflow = True
+                return frames
+            if len(self.buffer) - start - 4 < size:
+                break
+            frames.append(bytes(self.buffer[start + 4:start + 4 + size]))
+            start += 4 + size
+
+        del self.buffer[:start]
+        return frames
+
+
+def encode_length_frame(payload):
+    """Frames a payload with its length."""
+    return len(payload).to_bytes(4, 'big') + payload
@@ -3,6 +3,14 @@
 
 """
 
+import time
+
+
+def elementwise(func):
+    """Marks a function that also works on whole arrays."""
+    func.elementwise = True
+    return func
+
 
 def hello():
     return 'Hi!'
@@ -12,21 +20,41 @@ def greet(name):
     return 'Hello ' + name
 
 
+@elementwise
 def add(a, b):
     return a + b
 
 
+@elementwise
 def sub(a, b):
     return a - b
 
 
+@elementwise
 def mul(a, b):
     return a * b
 
 
+@elementwise
 def div(a, b):
     return a / b
 
 
 def add3(a, b, c):
     return a + b + c
+
+
+def wait(seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+def fib(n):
+    if n < 2:
+        return n
+    return fib(n - 1) + fib(n - 2)
+
+
+def numbers(n):
+    for i in range(n):
+        yield i
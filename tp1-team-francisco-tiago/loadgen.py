@@ -0,0 +1,204 @@
+"""
+ JSON-RPC Load Generator
+
+ Starts a local JSONRPCServer, drives it with a mix of the functions in
+ functions.py and writes the throughput and latency of every mode to a
+ JSON file, e.g.
+
+     python loadgen.py --concurrency 16 --calls 5000 --mix add=3,greet=1
+
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import functions
+from client import JSONRPCClient, PipelinedJSONRPCClient
+from server import JSONRPCServer
+
+
+# Define server host and port
+SERVER_HOST = '127.0.0.1'
+SERVER_PORT = 8002
+
+# How the calls of each mode reach the server
+MODES = ('per-call', 'persistent', 'pipelined')
+
+# Builds the parameters of a method for a payload size
+PARAMS = {
+    'hello': lambda size: [],
+    'greet': lambda size: ['x' * size],
+    'add': lambda size: [4, 2],
+    'sub': lambda size: [4, 2],
+    'mul': lambda size: [4, 2],
+    'div': lambda size: [4, 2],
+    'add3': lambda size: [1, 2, 3],
+    'fib': lambda size: [15]
+}
+
+
+def make_calls(mix, count, payload, seed=0):
+    """Draws the calls to make from a {method: weight} mix."""
+    rng = random.Random(seed)
+    methods = rng.choices(list(mix), weights=list(mix.values()), k=count)
+    params = {method: PARAMS[method](payload) for method in mix}
+    return [(method, params[method]) for method in methods]
+
+
+def percentile(values, fraction):
+    """Returns a percentile of sorted values, by nearest rank."""
+    if not values:
+        return None
+    rank = max(int(round(fraction * len(values))) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def run_sequential(calls, concurrency, connect):
+    """Makes the calls from several threads, each waiting for every answer."""
+    latencies = []
+    errors = []
+
+    def worker(share):
+        client = connect()
+        for method, params in share:
+            start = time.perf_counter()
+            try:
+                client.invoke(method, params)
+            except Exception:
+                errors.append(method)
+            latencies.append(time.perf_counter() - start)
+            client = connect(client)
+        client.close()
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        for _ in executor.map(worker, [calls[i::concurrency] for i in range(concurrency)]):
+            pass
+    return latencies, len(errors)
+
+
+def run_pipelined(calls, concurrency, depth, host, port):
+    """Makes the calls on one shared connection, with depth calls in flight per thread."""
+    client = PipelinedJSONRPCClient(host, port)
+    latencies = []
+    errors = []
+
+    def done(future, start):
+        latencies.append(time.perf_counter() - start)
+        if future.exception() is not None:
+            errors.append(future)
+
+    def worker(share):
+        window = deque()
+        for method, params in share:
+            if len(window) >= depth:
+                window.popleft().exception()
+            start = time.perf_counter()
+            future = client.submit(method, params)
+            future.add_done_callback(lambda future, start=start: done(future, start))
+            window.append(future)
+        for future in window:
+            future.exception()
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        for _ in executor.map(worker, [calls[i::concurrency] for i in range(concurrency)]):
+            pass
+    client.close()
+    return latencies, len(errors)
+
+
+def run_mode(mode, calls, concurrency, depth=8, host=SERVER_HOST, port=SERVER_PORT):
+    """Runs the calls in a mode and returns its results."""
+    def per_call(client=None):
+        # A new connection for every call
+        if client is not None:
+            client.close()
+        return JSONRPCClient(host, port)
+
+    def persistent(client=None):
+        # The same connection for every call of a thread
+        return client or JSONRPCClient(host, port)
+
+    start = time.perf_counter()
+    if mode == 'per-call':
+        latencies, errors = run_sequential(calls, concurrency, per_call)
+    elif mode == 'persistent':
+        latencies, errors = run_sequential(calls, concurrency, persistent)
+    elif mode == 'pipelined':
+        latencies, errors = run_pipelined(calls, concurrency, depth, host, port)
+    else:
+        raise ValueError('Unknown mode %r' % mode)
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'mode': mode,
+        'calls': len(calls),
+        'errors': errors,
+        'seconds': elapsed,
+        'requests_per_second': len(calls) / elapsed,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000
+    }
+
+
+def run_load(mix, calls=2000, concurrency=8, payload=16, modes=MODES, depth=8,
+             port=SERVER_PORT):
+    """Starts a local server and runs every mode against it."""
+    server = JSONRPCServer(SERVER_HOST, port, verbose=False)
+    for method in mix:
+        server.register(method, getattr(functions, method))
+    thread = threading.Thread(target=server.start)
+    thread.start()
+    server.ready.wait()
+
+    try:
+        todo = make_calls(mix, calls, payload)
+        results = []
+        for mode in modes:
+            result = run_mode(mode, todo, concurrency, depth, SERVER_HOST, port)
+            result.update(concurrency=concurrency, payload=payload, mix=mix)
+            results.append(result)
+        return results
+    finally:
+        server.stop()
+        thread.join()
+
+
+def parse_mix(text):
+    """Parses a method mix such as 'add=3,greet=1'."""
+    mix = {}
+    for item in text.split(','):
+        method, _, weight = item.partition('=')
+        if method not in PARAMS:
+            raise argparse.ArgumentTypeError('Unknown method %r' % method)
+        mix[method] = float(weight or 1)
+    return mix
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Load test the JSON-RPC server.')
+    parser.add_argument('--calls', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--payload', type=int, default=16,
+                        help='size of the string sent to greet')
+    parser.add_argument('--mix', type=parse_mix, default={'add': 3, 'greet': 1, 'hello': 1})
+    parser.add_argument('--modes', default=','.join(MODES))
+    parser.add_argument('--depth', type=int, default=8,
+                        help='calls in flight per thread when pipelined')
+    parser.add_argument('--output', default='loadgen.json')
+    args = parser.parse_args()
+
+    results = run_load(args.mix, args.calls, args.concurrency, args.payload,
+                       args.modes.split(','), args.depth)
+    for result in results:
+        print('%-10s %10.0f req/s  p50 %7.2f ms  p95 %7.2f ms  p99 %7.2f ms  errors %d' % (
+            result['mode'], result['requests_per_second'], result['p50_ms'],
+            result['p95_ms'], result['p99_ms'], result['errors']))
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2)
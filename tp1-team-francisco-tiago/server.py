@@ -3,66 +3,612 @@
 
 """
 
-import json
+import asyncio
+import multiprocessing
+import os
+import signal
 import socket
+import threading
+import time
+import traceback
+from collections.abc import Iterator
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import islice
 import functions
+from cache import MISSING, cache_key
+from codec import CODECS, JSONCodec
+from stats import Stats
+from transport import LOCAL_SERVERS, InProcessSocket, local_name, unix_path
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Collection of errors
+ERRORS = {
+    '-32601': {'code': -32601, 'message': 'Method not found'},
+    '-32602': {'code': -32602, 'message': 'Invalid params'},
+    '-32600': {'code': -32600, 'message': 'Invalid Request'},
+    '-32700': {'code': -32700, 'message': 'Parse error'},
+    '-32603': {'code': -32603, 'message': 'Internal error'},
+    '-32000': {'code': -32000, 'message': 'Server busy'}
+}
+
+# Items sent in each partial response of a streamed result
+STREAM_CHUNK = 64
+
+# What to do with a notification when the notification queue is full
+POLICIES = ('drop', 'block', 'shed-oldest')
+
+# Seconds to wait before restarting a worker that crashed right after starting
+RESTART_DELAY = 1.0
+
+# Executors a function can be registered on
+EXECUTORS = {
+    'thread': ThreadPoolExecutor,
+    'process': ProcessPoolExecutor
+}
+
+
+class RPCError(Exception):
+    """Error raised by a call to be answered with a given code."""
+
+    def __init__(self, code):
+        super().__init__(ERRORS[code]['message'])
+        self.code = code
+
+
+class JSONRPCProtocol(asyncio.Protocol):
+    """Handles a client connection inside the event loop."""
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.codec = JSONCodec
+        self.reader = JSONCodec.reader(server.max_message)
+        self.switch_to = None
+        self.writable = asyncio.Event()
+        self.writable.set()
+        self.blocked = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.server.connections.add(transport)
+
+    def connection_lost(self, exc):
+        self.server.connections.discard(self.transport)
+        self.writable.set()
+
+    def pause_writing(self):
+        self.writable.clear()
+
+    def resume_writing(self):
+        self.writable.set()
+
+    def data_received(self, data):
+        responses = []
+        for msg in self.reader.feed(data):
+            res = self.server.handle_message(msg, self)
+            if asyncio.isfuture(res):
+                res.add_done_callback(self.send_future)
+            elif res:
+                responses.append(self.codec.frame(res))
+
+        # A message over the size limit cannot be resynchronised
+        if self.reader.overflow:
+            responses.append(self.codec.frame(
+                self.codec.dumps(error_response('No ID', '-32600'))))
+            self.transport.write(b''.join(responses))
+            self.transport.close()
+            return
+
+        # Send responses, the connection stays open for further requests
+        if responses:
+            self.transport.write(b''.join(responses))
+
+        # The answer to rpc.negotiate is the last message in the old codec
+        if self.switch_to is not None:
+            self.codec, self.switch_to = self.switch_to, None
+            rest = bytes(self.reader.buffer)
+            self.reader = self.codec.reader(self.server.max_message)
+            if rest:
+                self.data_received(rest)
+
+    def send_future(self, future):
+        """Sends a response that was computed asynchronously."""
+        if future.cancelled():
+            return
+        res = future.result()
+        if res and not self.transport.is_closing():
+            self.transport.write(self.codec.frame(res))
 
 
 class JSONRPCServer:
-    """The JSON-RPC server."""
+    """
+    The JSON-RPC server.
 
-    def __init__(self, host, port):
+    The host may also be 'unix:///path' to listen on a Unix domain socket,
+    or 'inproc://name' to only serve clients of the same process, see
+    transport.py.
+    """
+
+    def __init__(self, host, port, batch_workers=None, verbose=True,
+                 max_message=16 * 1024 * 1024, stats=True):
         self.host = host
         self.port = port
+        self.verbose = verbose
+        self.max_message = max_message
         self.sock = None
+        self.loop = None
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.stopping = False
+        self.worker = False
+        self.workers = {}
+        self.notify = None
         self.funcs = {}
+        self.routes = {}
+        self.caches = {}
+        self.flights = {}
+        self.connections = set()
+
+        # Pools for the functions that must not run inside the event loop
+        self.executors = {kind: BoundedExecutor(pool_class)
+                          for kind, pool_class in EXECUTORS.items()}
+
+        # Optional pool to run the entries of a batch concurrently
+        self.batch_executor = None
+        if batch_workers:
+            self.batch_executor = BoundedExecutor(ThreadPoolExecutor, batch_workers)
+
+        # Notifications run in the background, see configure_notifications
+        self.notifications = NotificationQueue(self)
+
+        # Call statistics, leave them out to save their cost
+        self.stats = Stats() if stats else None
+
+        # Built-in methods
+        self.register('rpc.map', self.map_calls)
+        if self.stats is not None:
+            self.register('rpc.stats', self.report_stats)
+
+    def register(self, name, function, executor='inline', cache=None):
+        """
+        Registers a function.
 
-    def register(self, name, function):
-        """Registers a function."""
+        Inline functions run in the event loop. Blocking functions should be
+        registered on the 'thread' executor and CPU-bound functions on the
+        'process' executor, which requires them to be picklable.
+
+        Pure functions may be given a cache, e.g. cache=LRU(1024, ttl=60),
+        so repeated calls are answered without invoking them.
+        """
+        if executor != 'inline' and executor not in self.executors:
+            raise ValueError('Unknown executor %r' % executor)
         self.funcs[name] = function
+        self.routes[name] = executor
+        if cache is not None:
+            self.caches[name] = cache
+        else:
+            self.caches.pop(name, None)
+
+    def configure_executor(self, executor, workers=None, max_queue=None):
+        """Sets the number of workers and the queue limit of an executor."""
+        if executor not in self.executors:
+            raise ValueError('Unknown executor %r' % executor)
+        self.executors[executor].shutdown()
+        self.executors[executor] = BoundedExecutor(EXECUTORS[executor], workers, max_queue)
+
+    def configure_notifications(self, max_queue=1024, policy='drop', workers=1):
+        """
+        Sets how notifications are run.
+
+        Notifications are queued and run in the background by the given
+        number of workers, after their sender moved on. When max_queue
+        notifications are waiting, a new one is dropped, or the oldest
+        waiting one is dropped with 'shed-oldest', or with 'block' the
+        connection that sent it is not read until there is room.
+        """
+        if policy not in POLICIES:
+            raise ValueError('Unknown policy %r' % policy)
+        self.notifications = NotificationQueue(self, max_queue, policy, workers)
+
+    def notification_stats(self):
+        """Returns the counters of the notification queue."""
+        return self.notifications.stats()
+
+    def map_calls(self, method, args, columnar=False):
+        """
+        Applies a function to many argument tuples in one request.
+
+        The args are a list of tuples, or a list of columns if columnar is
+        set. Functions marked elementwise are applied to whole NumPy arrays
+        when NumPy is installed and every column is numeric.
+        """
+        func = self.funcs.get(method)
+        if func is None or method.startswith('rpc.'):
+            raise RPCError('-32601')
+
+        # Every tuple, or every column, must have the same length
+        if len({len(item) for item in args}) > 1:
+            raise RPCError('-32602')
+        if not columnar:
+            args = list(zip(*args))
+        if not args:
+            return []
+
+        if numpy is not None and getattr(func, 'elementwise', False):
+            columns = [numpy.asarray(column) for column in args]
+            if all(column.dtype.kind in 'iuf' for column in columns):
+                try:
+                    with numpy.errstate(all='raise'):
+                        return func(*columns).tolist()
+                except (ArithmeticError, TypeError, ValueError):
+                    # Let the plain calls report the error
+                    pass
+
+        return [func(*row) for row in zip(*args)]
+
+    def bind(self, reuse_port=False):
+        """Creates the listening socket."""
+        path = unix_path(self.host)
+        if path is not None:
+            if reuse_port:
+                raise ValueError('Unix domain sockets cannot be shared with SO_REUSEPORT')
+            # Remove the socket file left by a previous server
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            sock = socket.socket(socket.AF_UNIX)
+            sock.bind(path)
+            return sock
+
+        if local_name(self.host) is not None:
+            raise ValueError('In-process servers have no socket')
+        sock = socket.socket()
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((self.host, self.port))
+        return sock
+
+    def report_stats(self, fmt='json'):
+        """Returns the call statistics, as data or in the Prometheus text format."""
+        notifications = self.notification_stats()
+        if fmt == 'json':
+            stats = self.stats.snapshot()
+            stats['notifications'] = notifications
+            return stats
+        if fmt == 'prometheus':
+            text = self.stats.prometheus()
+            for name, value in notifications.items():
+                if name in ('depth', 'max_queue'):
+                    text += '# TYPE rpc_notifications_%s gauge\n' % name
+                    text += 'rpc_notifications_%s %d\n' % (name, value)
+                elif name != 'policy':
+                    text += '# TYPE rpc_notifications_%s_total counter\n' % name
+                    text += 'rpc_notifications_%s_total %d\n' % (name, value)
+            return text
+        raise RPCError('-32602')
 
     def start(self):
         """Starts the server."""
-        self.sock = socket.socket()
-        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.sock.bind((self.host, self.port))
-        self.sock.listen(1)
-        print('Listening on port %s ...' % self.port)
+        name = local_name(self.host)
+        if name is not None:
+            # Clients of the process connect through connect_local
+            self.sock = None
+            LOCAL_SERVERS[name] = self
+            try:
+                self.run()
+            finally:
+                if LOCAL_SERVERS.get(name) is self:
+                    del LOCAL_SERVERS[name]
+            return
 
+        self.sock = self.bind()
+        path = unix_path(self.host)
+        if self.verbose:
+            print('Listening on %s ...' % (path or 'port %s' % self.port))
         try:
-            while True:
-                # Accepts and handles client
-                conn, _ = self.sock.accept()
-                self.handle_client(conn)
+            self.run()
+        finally:
+            if path is not None:
+                os.unlink(path)
 
-                # Close client connection
-                conn.close()
+    def connect_local(self):
+        """Opens a connection from the same process, without a socket."""
+        with self.lock:
+            if self.loop is None or self.loop.is_closed():
+                raise ConnectionRefusedError('Server is not running')
+            sock = InProcessSocket(self.loop)
+            self.loop.call_soon_threadsafe(sock.transport.attach, JSONRPCProtocol(self))
+        return sock
 
-        except ConnectionAbortedError:
-            pass
-        except OSError:
-            pass
+    def serve_forever(self, workers=None, setup=None, reuse_port=False):
+        """
+        Starts the server on several worker processes, one per core by default.
+
+        The workers are forked and share the listening socket, or bind their
+        own with SO_REUSEPORT if reuse_port is set. setup(server) runs in
+        each worker before it serves, e.g. to register functions or open
+        resources that cannot be shared across fork. Workers that exit are
+        restarted until stop() is called.
+        """
+        workers = workers or os.cpu_count() or 1
+        if not reuse_port:
+            self.sock = self.bind()
+            self.sock.listen(socket.SOMAXCONN)
+        if self.verbose:
+            print('Listening on port %s with %d workers ...' % (self.port, workers))
+
+        try:
+            # Ready once every worker is set up and listening
+            for notify in [self.spawn(setup, reuse_port) for _ in range(workers)]:
+                if notify is not None:
+                    os.read(notify, 1)
+                    os.close(notify)
+            self.ready.set()
+
+            while self.workers:
+                try:
+                    time.sleep(0.05)
+                except KeyboardInterrupt:
+                    self.stop()
+                for pid in list(self.workers):
+                    if os.waitpid(pid, os.WNOHANG)[0]:
+                        self.restart(pid, setup, reuse_port)
+        finally:
+            with self.lock:
+                for pid in self.workers:
+                    os.kill(pid, signal.SIGTERM)
+            for pid in list(self.workers):
+                os.waitpid(pid, 0)
+            with self.lock:
+                self.workers.clear()
+                self.stopping = False
+            self.ready.clear()
+            if self.sock is not None:
+                self.sock.close()
+
+    def restart(self, pid, setup, reuse_port):
+        """Replaces a worker that exited, unless the server is stopping."""
+        with self.lock:
+            started = self.workers.pop(pid)
+            if self.stopping:
+                return
+        if self.verbose:
+            print('Worker %d exited, restarting' % pid)
+
+        # Do not keep restarting a worker that cannot start
+        if time.monotonic() - started < RESTART_DELAY:
+            time.sleep(RESTART_DELAY)
+        notify = self.spawn(setup, reuse_port)
+        if notify is not None:
+            os.close(notify)
+
+    def spawn(self, setup, reuse_port):
+        """
+        Forks a worker process.
+
+        Returns a pipe the worker writes to once it listens, or None if the
+        server is stopping.
+        """
+        with self.lock:
+            if self.stopping:
+                return None
+            notify, self.notify = os.pipe()
+            pid = os.fork()
+            if pid:
+                os.close(self.notify)
+                self.notify = None
+                self.workers[pid] = time.monotonic()
+                return notify
+
+        # Worker process, never returns to the caller
+        code = 0
+        try:
+            os.close(notify)
+            self.lock = threading.Lock()
+            self.workers = {}
+            self.worker = True
+
+            # The parent coordinates Ctrl+C, SIGTERM stops the worker
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            if reuse_port:
+                self.sock = self.bind(reuse_port=True)
+            if setup is not None:
+                setup(self)
+            self.run()
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        finally:
+            os._exit(code)
+
+    def run(self):
+        """Serves the clients of the listening socket until stop() is called."""
+
+        # Multiplexes every client connection in a single event loop
+        with self.lock:
+            self.loop = asyncio.new_event_loop()
+            if self.worker:
+                self.loop.add_signal_handler(signal.SIGTERM, self.loop.stop)
+        try:
+            self.notifications.start()
+            server = None
+            if self.sock is not None:
+                server = self.loop.run_until_complete(self.loop.create_server(
+                    lambda: JSONRPCProtocol(self), sock=self.sock,
+                    backlog=socket.SOMAXCONN))
+            self.ready.set()
+            if self.notify is not None:
+                try:
+                    os.write(self.notify, b'.')
+                except OSError:
+                    # Restarted workers are not waited for
+                    pass
+                os.close(self.notify)
+                self.notify = None
+            with self.lock:
+                stopping = self.stopping
+            if not stopping:
+                self.loop.run_forever()
+
+            # Stop listening, then let the calls in flight answer
+            if server is not None:
+                server.close()
+            self.loop.run_until_complete(self.notifications.close())
+            self.loop.run_until_complete(self.drain())
+            for transport in list(self.connections):
+                transport.close()
+            if server is not None:
+                self.loop.run_until_complete(server.wait_closed())
+        finally:
+            with self.lock:
+                self.loop.close()
+                self.stopping = False
+            self.ready.clear()
+            for executor in self.executors.values():
+                executor.shutdown()
+            if self.batch_executor is not None:
+                self.batch_executor.shutdown()
+
+    async def drain(self, timeout=1.0):
+        """Waits for the pending tasks, cancelling the ones left after the timeout."""
+        tasks = asyncio.all_tasks() - {asyncio.current_task()}
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=timeout)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+        # Run the callbacks that write the last responses
+        await asyncio.sleep(0)
 
     def stop(self):
-        """Stops the server."""
-        self.sock.close()
-
-    def handle_client(self, conn):
-        """Handles the client connection."""
-
-        # Collection of errors
-        errors = {
-            '-32601': {'code': -32601, 'message': 'Method not found'},
-            '-32602': {'code': -32602, 'message': 'Invalid params'},
-            '-32600': {'code': -32600, 'message': 'Invalid Request'},
-            '-32700': {'code': -32700, 'message': 'Parse error'}
+        """Stops the server, it is safe to call at any time."""
+        with self.lock:
+            if self.workers:
+                # Pre-fork parent, the workers answer their calls in flight
+                if not self.stopping:
+                    self.stopping = True
+                    for pid in self.workers:
+                        os.kill(pid, signal.SIGTERM)
+            elif self.loop is None:
+                # Not started yet, start() will return right away
+                self.stopping = True
+            elif not self.loop.is_closed():
+                self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def handle_message(self, msg, conn=None):
+        """
+        Handles an encoded message and returns the encoded response, or a
+        future of it.
+
+        The message is decoded with the codec of the connection, JSON when
+        there is none.
+        """
+        codec = conn.codec if conn is not None else JSONCodec
+        if self.verbose:
+            print('Received:', msg.decode(errors='replace'))
+
+        start = time.perf_counter() if self.stats is not None else None
+        try:
+            msg = codec.loads(msg)
+        except ValueError:
+            # Invalid message or invalid UTF-8
+            return codec.dumps(self.rejected(error_response('No ID', '-32700')))
+        if start is not None:
+            self.stats.decode.observe(time.perf_counter() - start)
+
+        if isinstance(msg, list):
+            return self.handle_batch(msg, codec, conn)
+
+        if conn is not None and isinstance(msg, dict) and msg.get('method') == 'rpc.negotiate':
+            return encode_response(self.negotiate(msg, conn), codec)
+
+        res = self.handle_request(msg, conn=conn, streams=True)
+        if res is None:
+            return b''
+        if asyncio.isfuture(res):
+            return asyncio.ensure_future(self.encode_later(res, codec))
+        return self.encode(encode_response, res, codec)
+
+    def encode(self, encoder, res, codec):
+        """Encodes a response, or the responses of a batch, with an encoder."""
+        if self.stats is None:
+            return encoder(res, codec)
+        start = time.perf_counter()
+        data = encoder(res, codec)
+        self.stats.encode.observe(time.perf_counter() - start)
+        return data
+
+    def rejected(self, res):
+        """Counts the error of a request rejected before dispatch."""
+        if self.stats is not None:
+            self.stats.errors[res['error']['code']] += 1
+        return res
+
+    def negotiate(self, req, conn):
+        """
+        Picks the codec of a connection from the ones the client supports.
+
+        The params are codec names in order of preference, the first one the
+        server knows is used after the response, which is still sent in the
+        current codec. JSON is kept when none is known.
+        """
+        res = {
+            'jsonrpc': '2.0',
+            'id': req.get('id', 'No ID')
         }
+        names = req.get('params')
+        if not isinstance(names, list) or not all(isinstance(name, str) for name in names):
+            res['error'] = ERRORS['-32602']
+            return res
+
+        name = next((name for name in names if name in CODECS), conn.codec.name)
+        if CODECS[name] is not conn.codec:
+            conn.switch_to = CODECS[name]
+        res['result'] = name
+        return res
+
+    async def encode_later(self, future, codec):
+        """Waits for a response and encodes it."""
+        res = await future
+        if res is None:
+            return b''
+        return self.encode(encode_response, res, codec)
+
+    def handle_batch(self, reqs, codec=JSONCodec, conn=None):
+        """Handles a batch of requests decoded from a single message."""
+        if not reqs:
+            return codec.dumps(self.rejected(error_response('No ID', '-32600')))
 
-        # Receive message
-        msg = conn.recv(1024).decode()
-        print('Received:', msg)
+        # Inline entries of a batch run concurrently on the batch pool
+        default = self.batch_executor if len(reqs) > 1 else None
+        responses = [self.handle_request(req, default, conn) for req in reqs]
+        if any(asyncio.isfuture(res) for res in responses):
+            return asyncio.ensure_future(self.gather_batch(responses, codec))
 
-        # Prepare response
+        return self.encode(encode_batch, responses, codec)
+
+    async def gather_batch(self, responses, codec):
+        """Waits for the batch entries and returns the batch response."""
+        return self.encode(encode_batch, [await res if asyncio.isfuture(res) else res
+                                          for res in responses], codec)
+
+    def handle_request(self, req, default=None, conn=None, streams=False):
+        """
+        Handles a single request and returns the response, or a future of it.
+
+        If streams is set, requests with "stream": true made on a connection
+        get results that are lists or iterators as partial responses, see
+        stream(). Notifications are queued and get no response.
+        """
 
         # Default response
         res = {
@@ -70,36 +616,389 @@ class JSONRPCServer:
             'id': 'No ID'
         }
         try:
-            msg = json.loads(msg)
-            method = msg['method']
+            method = req['method']
 
             try:
-                params = msg['params']
+                params = req['params']
             except KeyError:
                 params = ''
 
-            if 'id' not in msg:
-                res = ''
-                return
+            notification = 'id' not in req
+            if not notification:
+                res['id'] = req['id']
 
-            res['id'] = msg['id']
+        except (KeyError, TypeError):
+            res['error'] = ERRORS['-32600']
+            return self.rejected(res)
 
+        try:
+            func = self.funcs[method]
+        except (KeyError, TypeError):
+            if notification:
+                return None
+            res['error'] = ERRORS['-32601']
+            return self.rejected(res)
+
+        if notification:
+            self.notifications.put(func, params, self.executors.get(self.routes.get(method)), conn)
+            return None
+
+        stream = streams and conn is not None and req.get('stream') is True
+        if self.stats is None:
+            return self.dispatch(method, func, params, res, default, conn, stream)
+
+        # Dispatch is measured from here to the response
+        start = time.perf_counter()
+        res = self.dispatch(method, func, params, res, default, conn, stream)
+        if asyncio.isfuture(res):
+            res.add_done_callback(lambda future: self.record(method, future, start))
+        else:
+            self.stats.record(method, res, time.perf_counter() - start)
+        return res
+
+    def record(self, method, future, start):
+        """Records a call that was answered asynchronously."""
+        if not future.cancelled() and future.exception() is None:
+            self.stats.record(method, future.result(), time.perf_counter() - start)
+
+    def dispatch(self, method, func, params, res, default=None, conn=None, stream=False):
+        """Runs a valid request and returns the response, or a future of it."""
+
+        # Serve pure functions from their cache, identical calls still
+        # running share their result and are not counted as misses
+        cache = self.caches.get(method) if not stream else None
+        key = None
+        if cache is not None:
+            key = cache_key(method, params)
+            future = self.flights.get(key)
+            if future is not None:
+                cache.collapsed += 1
+                return asyncio.ensure_future(self.respond_later(res, future))
+
+            value = cache.get(key)
+            if value is not MISSING:
+                res['result'] = value
+                return res
+
+        executor = self.executors.get(self.routes.get(method), default)
+        if executor is None:
             try:
-                func = self.funcs[method]
-                res['result'] = func(*params)
-            except KeyError:
-                res['error'] = errors['-32601']
-            except TypeError:
-                res['error'] = errors['-32602']
-
-        except KeyError:
-            res['error'] = errors['-32600']
-        except json.decoder.JSONDecodeError:
-            res['error'] = errors['-32700']
-
-        # Send response
-        res = json.dumps(res)
-        conn.send(res.encode())
+                result = func(*params)
+                if stream and streamable(result):
+                    return asyncio.ensure_future(self.stream(conn, res, iter(result)))
+                res['result'] = collect(result)
+            except Exception as error:
+                res['error'] = call_error(error)
+            else:
+                if cache is not None:
+                    cache.put(key, res['result'])
+            return res
+
+        # Reject the call right away instead of queueing without bound
+        if executor.full():
+            res['error'] = ERRORS['-32000']
+            return res
+
+        # Generators cannot leave a worker process, they are collected there
+        lazy = stream and executor.pool_class is not ProcessPoolExecutor
+        future = self.submit(executor, func, params, not lazy)
+        if cache is not None:
+            self.flights[key] = future
+            future.add_done_callback(lambda future: self.land(cache, key, future))
+        if stream:
+            return asyncio.ensure_future(self.stream_later(conn, res, future, executor))
+        return asyncio.ensure_future(self.respond_later(res, future))
+
+    def submit(self, executor, func, params, collected=True):
+        """Runs a call on an executor and returns the future of its result."""
+        executor.depth += 1
+        future = self.loop.run_in_executor(executor.get_pool(), call, func, params, collected)
+        future.add_done_callback(executor.release)
+        return future
+
+    def land(self, cache, key, future):
+        """Caches the result of a finished call."""
+        del self.flights[key]
+        if not future.cancelled() and future.exception() is None:
+            cache.put(key, future.result())
+
+    async def respond_later(self, res, future):
+        """Waits for the result of a call and returns the response."""
+        try:
+            res['result'] = await future
+        except Exception as error:
+            res['error'] = call_error(error)
+        return res
+
+    async def stream_later(self, conn, res, future, executor):
+        """Waits for the result of a call and streams it."""
+        try:
+            result = await future
+        except Exception as error:
+            res['error'] = call_error(error)
+            return res
+        if not streamable(result):
+            res['result'] = result
+            return res
+        return await self.stream(conn, res, iter(result), executor)
+
+    async def stream(self, conn, res, items, executor=None):
+        """
+        Sends the items of a result as partial responses and returns the
+        final response.
+
+        Every partial response has the request id and a list of up to
+        STREAM_CHUNK items under "partial". The final response has the
+        number of items as its result and "done": true, or the error that
+        ended the stream. Items are taken from the iterator only while the
+        client keeps up, on the executor of the call if it has threads.
+        """
+        partial = {'jsonrpc': '2.0', 'id': res['id']}
+        pool = None
+        if executor is not None and executor.pool_class is not ProcessPoolExecutor:
+            pool = executor.get_pool()
+        count = 0
+        try:
+            while True:
+                if pool is None:
+                    chunk = take(items)
+                else:
+                    chunk = await self.loop.run_in_executor(pool, take, items)
+                if not chunk:
+                    break
+
+                # Do not buffer more than the transport allows
+                await conn.writable.wait()
+                if conn.transport.is_closing():
+                    return None
+                partial['partial'] = chunk
+                try:
+                    data = conn.codec.dumps(partial)
+                except (TypeError, ValueError):
+                    res['error'] = ERRORS['-32603']
+                    break
+                conn.transport.write(conn.codec.frame(data))
+                count += len(chunk)
+
+                # Let the other connections run between chunks
+                await asyncio.sleep(0)
+        except Exception as error:
+            res['error'] = call_error(error)
+        finally:
+            # Stop generators the client will not read to the end
+            close = getattr(items, 'close', None)
+            if close is not None:
+                try:
+                    close()
+                except ValueError:
+                    # Still running on the executor after a cancellation
+                    pass
+
+        if 'error' not in res:
+            res['result'] = count
+        res['done'] = True
+        return res
+
+    def cache_stats(self):
+        """
+        Returns the counters of every cache.
+
+        Calls that joined an identical call still running are counted as
+        collapsed, not as hits or misses.
+        """
+        return {name: cache.stats() for name, cache in self.caches.items()}
+
+
+class BoundedExecutor:
+    """Worker pool with a limit on the calls waiting or running in it."""
+
+    def __init__(self, pool_class, workers=None, max_queue=None):
+        self.pool_class = pool_class
+        self.workers = workers
+        self.max_queue = max_queue
+        self.pool = None
+        self.depth = 0
+
+    def get_pool(self):
+        """Returns the pool, creating it on first use."""
+        if self.pool is None:
+            if self.pool_class is ProcessPoolExecutor:
+                # Spawned workers do not inherit the server sockets
+                self.pool = ProcessPoolExecutor(
+                    self.workers, mp_context=multiprocessing.get_context('spawn'))
+            else:
+                self.pool = self.pool_class(self.workers)
+        return self.pool
+
+    def full(self):
+        """Checks if the queue limit was reached."""
+        return self.max_queue is not None and self.depth >= self.max_queue
+
+    def release(self, future):
+        """Frees the queue slot of a finished call."""
+        self.depth -= 1
+
+    def shutdown(self):
+        """Shuts down the pool."""
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+            self.pool = None
+
+
+class NotificationQueue:
+    """Bounded queue of notifications run in the background of the event loop."""
+
+    def __init__(self, server, max_queue=1024, policy='drop', workers=1):
+        self.server = server
+        self.max_queue = max_queue
+        self.policy = policy
+        self.workers = workers
+        self.queue = None
+        self.tasks = []
+        self.done = 0
+        self.failed = 0
+        self.dropped = 0
+        self.shed = 0
+        self.blocked = 0
+
+    def start(self):
+        """Starts the workers, inside the event loop of the server."""
+        self.queue = asyncio.Queue(self.max_queue)
+        self.tasks = [self.server.loop.create_task(self.work()) for _ in range(self.workers)]
+
+    async def close(self, timeout=1.0):
+        """Runs the queued notifications, then stops the workers."""
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    def put(self, func, params, executor, conn=None):
+        """Queues a notification, applying the policy if the queue is full."""
+        item = (func, params, executor)
+        if not self.queue.full():
+            self.queue.put_nowait(item)
+        elif self.policy == 'shed-oldest':
+            self.queue.get_nowait()
+            self.queue.task_done()
+            self.queue.put_nowait(item)
+            self.shed += 1
+        elif self.policy == 'block':
+            self.blocked += 1
+            task = asyncio.ensure_future(self.queue.put(item))
+            if conn is not None:
+                # Stop reading the sender until its notifications fit
+                conn.blocked += 1
+                conn.transport.pause_reading()
+                task.add_done_callback(lambda task: self.unblock(conn))
+        else:
+            self.dropped += 1
+
+    def unblock(self, conn):
+        """Reads a blocked connection again once all its notifications are queued."""
+        conn.blocked -= 1
+        if not conn.blocked:
+            conn.transport.resume_reading()
+
+    async def work(self):
+        """Runs queued notifications, their results and errors are discarded."""
+        while True:
+            func, params, executor = await self.queue.get()
+            try:
+                if executor is None:
+                    call(func, params)
+                else:
+                    await self.server.submit(executor, func, params)
+                self.done += 1
+            except Exception:
+                self.failed += 1
+            finally:
+                self.queue.task_done()
+
+    def stats(self):
+        """Returns the queue counters."""
+        return {
+            'policy': self.policy,
+            'max_queue': self.max_queue,
+            'depth': self.queue.qsize() if self.queue is not None else 0,
+            'done': self.done,
+            'failed': self.failed,
+            'dropped': self.dropped,
+            'shed': self.shed,
+            'blocked': self.blocked
+        }
+
+
+def call(func, params, collected=True):
+    """Calls a function, collecting the items of an iterator it returns."""
+    result = func(*params)
+    return collect(result) if collected else result
+
+
+def collect(result):
+    """Returns the items of an iterator as a list, other results as they are."""
+    if isinstance(result, Iterator):
+        return list(result)
+    return result
+
+
+def streamable(result):
+    """Checks if a result can be sent as partial responses."""
+    return isinstance(result, (list, tuple, Iterator))
+
+
+def take(items):
+    """Takes the next chunk of a streamed result."""
+    return list(islice(items, STREAM_CHUNK))
+
+
+def call_error(error):
+    """Returns the error for an exception raised by a call."""
+    if isinstance(error, RPCError):
+        return ERRORS[error.code]
+    if isinstance(error, TypeError):
+        return ERRORS['-32602']
+    return ERRORS['-32603']
+
+
+def error_response(rpcid, code):
+    """Builds an error response."""
+    return {
+        'jsonrpc': '2.0',
+        'id': rpcid,
+        'error': ERRORS[code]
+    }
+
+
+def encode_batch(responses, codec=JSONCodec):
+    """Encodes the responses of a batch, leaving out the notifications."""
+    responses = [res for res in responses if res is not None]
+    if not responses:
+        return b''
+    try:
+        return codec.dumps(responses)
+    except (TypeError, ValueError):
+        return codec.dumps([encodable(res, codec) for res in responses])
+
+
+def encode_response(res, codec=JSONCodec):
+    """Encodes a response, a result that cannot be encoded becomes an internal error."""
+    try:
+        return codec.dumps(res)
+    except (TypeError, ValueError):
+        return codec.dumps(error_response(res['id'], '-32603'))
+
+
+def encodable(res, codec):
+    """Returns the response, or an internal error if it cannot be encoded."""
+    try:
+        codec.dumps(res)
+    except (TypeError, ValueError):
+        return error_response(res['id'], '-32603')
+    return res
 
 
 if __name__ == "__main__":
@@ -0,0 +1,116 @@
+"""
+ Call statistics for the JSON-RPC server
+
+"""
+
+from bisect import bisect_left
+from collections import Counter, defaultdict
+
+
+# Upper bounds of the latency buckets, in seconds
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+           0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """Latency histogram with fixed buckets."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        """Adds a measure."""
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """Returns the (upper bound, measures up to it) pairs, ending at +Inf."""
+        pairs = []
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            pairs.append((bound, total))
+        return pairs
+
+    def snapshot(self):
+        """Returns the histogram as plain data."""
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'buckets': [[bound, total] for bound, total in self.cumulative()[:-1]]
+        }
+
+
+class Stats:
+    """
+    Call counts per method, error counts per code and latency histograms.
+
+    Decoding and encoding are measured per message, dispatch per method,
+    from the call to its response.
+    """
+
+    def __init__(self):
+        self.calls = Counter()
+        self.errors = Counter()
+        self.decode = Histogram()
+        self.encode = Histogram()
+        self.dispatch = defaultdict(Histogram)
+
+    def record(self, method, res, elapsed):
+        """Records a call to a registered method."""
+        self.calls[method] += 1
+        self.dispatch[method].observe(elapsed)
+        if res is not None and 'error' in res:
+            self.errors[res['error']['code']] += 1
+
+    def snapshot(self):
+        """Returns the statistics as plain data."""
+        return {
+            'calls': dict(self.calls),
+            'errors': {str(code): count for code, count in self.errors.items()},
+            'decode': self.decode.snapshot(),
+            'encode': self.encode.snapshot(),
+            'dispatch': {method: histogram.snapshot()
+                         for method, histogram in self.dispatch.items()}
+        }
+
+    def prometheus(self):
+        """Returns the statistics in the Prometheus text format."""
+        lines = ['# TYPE rpc_calls_total counter']
+        for method, count in self.calls.items():
+            lines.append('rpc_calls_total{method="%s"} %d' % (label(method), count))
+
+        lines.append('# TYPE rpc_errors_total counter')
+        for code, count in self.errors.items():
+            lines.append('rpc_errors_total{code="%d"} %d' % (code, count))
+
+        for name in ('decode', 'encode'):
+            lines.append('# TYPE rpc_%s_seconds histogram' % name)
+            lines.extend(histogram_lines('rpc_%s_seconds' % name, '', getattr(self, name)))
+
+        lines.append('# TYPE rpc_dispatch_seconds histogram')
+        for method, histogram in self.dispatch.items():
+            lines.extend(histogram_lines('rpc_dispatch_seconds',
+                                         'method="%s",' % label(method), histogram))
+        return '\n'.join(lines) + '\n'
+
+
+def histogram_lines(name, labels, histogram):
+    """Returns the Prometheus lines of a histogram."""
+    lines = []
+    for bound, total in histogram.cumulative():
+        bound = '+Inf' if bound == float('inf') else repr(bound)
+        lines.append('%s_bucket{%sle="%s"} %d' % (name, labels, bound, total))
+    labels = '{%s}' % labels.rstrip(',') if labels else ''
+    lines.append('%s_sum%s %r' % (name, labels, histogram.sum))
+    lines.append('%s_count%s %d' % (name, labels, histogram.count))
+    return lines
+
+
+def label(value):
+    """Escapes a Prometheus label value."""
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -3,13 +3,17 @@
 
 """
 
+import asyncio
 import json
 import socket
 import threading
+import time
 import unittest
 import concurrent.futures
 
-from client import JSONRPCClient
+from client import (AsyncJSONRPCClient, JSONRPCClient, JSONRPCClientPool,
+                    PipelinedJSONRPCClient)
+from codec import BinaryCodec
 
 
 # Define server host and port
@@ -40,11 +44,14 @@ class TestBase(unittest.TestCase):
 
     def send(self, msg):
         """Sends a message to the socket"""
-        self.conn.sendall(msg.encode())
+        self.conn.sendall(msg.encode() + b'\n')
 
     def recv(self):
         """Receives a message from a socket."""
-        return self.conn.recv(1024).decode()
+        res = b''
+        while not res.endswith(b'\n'):
+            res += self.conn.recv(1024)
+        return res.decode()
 
     def send_json(self, payload):
         """Sends json message to the socket."""
@@ -209,3 +216,404 @@ class TestErrors(TestBase):
             })
 
             self.assertRaises(TypeError, future.result)
+
+
+class TestFraming(TestBase):
+    """Tests the framing of JSON-RPC messages."""
+
+    def testLargeResult(self):
+        """Client must receive results larger than 1 KiB."""
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            future = executor.submit(self.client.hello)
+
+            req = self.recv_json()
+            self.jsonrpc_res(req['id'], result='x' * 100000)
+
+            self.assertEqual(future.result(), 'x' * 100000)
+
+    def testSplitResponse(self):
+        """Client must wait for the whole message."""
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            future = executor.submit(self.client.hello)
+
+            req = self.recv_json()
+            msg = json.dumps({'id': req['id'], 'jsonrpc': '2.0', 'result': 'Ok'})
+            self.conn.sendall(msg[:10].encode())
+            self.conn.sendall(msg[10:].encode() + b'\n')
+
+            self.assertEqual(future.result(), 'Ok')
+
+    def testSeveralCalls(self):
+        """Client must reuse the connection for several calls."""
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            for _ in range(3):
+                future = executor.submit(self.client.hello)
+                req = self.recv_json()
+                self.jsonrpc_res(req['id'], result='Ok')
+                self.assertEqual(future.result(), 'Ok')
+
+
+class TestBatch(TestBase):
+    """Tests JSON-RPC batch calls."""
+
+    def batch(self):
+        """Makes a batch of calls."""
+        with self.client.batch() as batch:
+            first = batch.add(1, 2)
+            second = batch.mul(3, 4)
+            third = batch.nofunc()
+        return batch, first, second, third
+
+    def testBatchRequest(self):
+        """Calls made in a batch must be sent in one array."""
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            future = executor.submit(self.batch)
+
+            reqs = self.recv_json()
+            self.send_json([{'id': req['id'], 'jsonrpc': '2.0', 'result': 'Ok'}
+                            for req in reqs])
+            future.result()
+
+            self.assertEqual([req['method'] for req in reqs], ['add', 'mul', 'nofunc'])
+            self.assertEqual(reqs[0]['params'], [1, 2])
+            self.assertEqual(len({req['id'] for req in reqs}), 3)
+
+    def testBatchResults(self):
+        """Results must be matched by id, even out of order."""
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            future = executor.submit(self.batch)
+
+            reqs = self.recv_json()
+            self.send_json([
+                {'id': reqs[2]['id'], 'jsonrpc': '2.0',
+                 'error': {'code': -32601, 'message': 'Method not found'}},
+                {'id': reqs[1]['id'], 'jsonrpc': '2.0', 'result': 12},
+                {'id': reqs[0]['id'], 'jsonrpc': '2.0', 'result': 3}
+            ])
+            batch, first, second, third = future.result()
+
+            self.assertEqual(first.result(), 3)
+            self.assertEqual(second.result(), 12)
+            self.assertRaises(AttributeError, third.result)
+            self.assertRaises(AttributeError, batch.results)
+
+
+class TestPipelined(TestBase):
+    """Tests clients with several requests in flight."""
+
+    def recv_lines(self, conn, count):
+        """Receives several json messages from a socket."""
+        res = b''
+        while res.count(b'\n') < count:
+            res += conn.recv(1024)
+        return [json.loads(line) for line in res.splitlines()]
+
+    def respond(self, conn, reqs):
+        """Answers requests in reverse order with the first param."""
+        for req in reversed(reqs):
+            conn.sendall(json.dumps({
+                'id': req['id'],
+                'jsonrpc': '2.0',
+                'result': req['params'][0]
+            }).encode() + b'\n')
+
+    def testAsyncClient(self):
+        """Responses must be matched to the requests by id."""
+        async def calls():
+            async with AsyncJSONRPCClient(SERVER_HOST, SERVER_PORT) as client:
+                return await asyncio.gather(client.echo(1), client.echo(2), client.echo(3))
+
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            future = executor.submit(asyncio.run, calls())
+            conn, _ = self.sock.accept()
+
+            # Every request is sent before the first response arrives
+            reqs = self.recv_lines(conn, 3)
+            self.assertEqual(len({req['id'] for req in reqs}), 3)
+            self.respond(conn, reqs)
+
+            self.assertEqual(future.result(), [1, 2, 3])
+            conn.close()
+
+    def testAsyncClientErrors(self):
+        """Errors must be raised by the awaitable."""
+        async def call():
+            async with AsyncJSONRPCClient(SERVER_HOST, SERVER_PORT) as client:
+                await client.nofunc()
+
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            future = executor.submit(asyncio.run, call())
+            conn, _ = self.sock.accept()
+
+            req = self.recv_lines(conn, 1)[0]
+            conn.sendall(json.dumps({
+                'id': req['id'],
+                'jsonrpc': '2.0',
+                'error': {'code': -32601, 'message': 'Method not found'}
+            }).encode() + b'\n')
+
+            self.assertRaises(AttributeError, future.result)
+            conn.close()
+
+    def testThreadSafeClient(self):
+        """Calls from several threads must share the connection."""
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            connect = executor.submit(PipelinedJSONRPCClient, SERVER_HOST, SERVER_PORT)
+            conn, _ = self.sock.accept()
+            client = connect.result()
+
+            futures = [executor.submit(client.echo, num) for num in range(4)]
+            reqs = self.recv_lines(conn, 4)
+            self.respond(conn, reqs)
+
+            self.assertEqual([future.result() for future in futures], [0, 1, 2, 3])
+            client.close()
+            conn.close()
+
+
+class TestClosedConnection(TestBase):
+    """Tests calls made after the server closed the connection."""
+
+    def testAsyncClient(self):
+        """Calls must fail right away with ConnectionError."""
+        async def call():
+            async with AsyncJSONRPCClient(SERVER_HOST, SERVER_PORT) as client:
+                conn, _ = await asyncio.get_running_loop().run_in_executor(
+                    None, self.sock.accept)
+                conn.close()
+                await asyncio.sleep(0.1)
+                await asyncio.wait_for(client.add(1, 2), 1)
+
+        self.assertRaises(ConnectionError, asyncio.run, call())
+
+    def testThreadSafeClient(self):
+        """Blocking calls must fail too instead of waiting forever."""
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            connect = executor.submit(PipelinedJSONRPCClient, SERVER_HOST, SERVER_PORT)
+            conn, _ = self.sock.accept()
+            client = connect.result()
+            conn.close()
+            time.sleep(0.1)
+
+            future = executor.submit(client.add, 1, 2)
+            self.assertRaises(ConnectionError, future.result, 1)
+            client.close()
+
+
+class TestMap(TestBase):
+    """Tests mapped calls."""
+
+    def testInvokeMap(self):
+        """Client must send a single rpc.map request."""
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            future = executor.submit(self.client.invoke_map, 'add', [[1, 2], [3, 4]])
+
+            req = self.recv_json()
+            self.jsonrpc_res(req['id'], result=[3, 7])
+
+            self.assertEqual(req['method'], 'rpc.map')
+            self.assertEqual(req['params'], ['add', [[1, 2], [3, 4]], False])
+            self.assertEqual(future.result(), [3, 7])
+
+
+class TestCodec(TestBase):
+    """Tests the codec negotiation."""
+
+    def connect(self, answer):
+        """Creates a binary client, answering its negotiation with answer."""
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            future = executor.submit(JSONRPCClient, SERVER_HOST, SERVER_PORT, 'binary')
+            conn, _ = self.sock.accept()
+            req = json.loads(recv_line(conn))
+            answer['id'] = req['id']
+            answer['jsonrpc'] = '2.0'
+            conn.sendall(json.dumps(answer).encode() + b'\n')
+            self.assertEqual(req['method'], 'rpc.negotiate')
+            self.assertEqual(req['params'], ['binary'])
+            return future.result(), conn
+
+    def testBinary(self):
+        """Client must use the binary codec once the server accepts it."""
+        client, conn = self.connect({'result': 'binary'})
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            future = executor.submit(client.add, 1, 2)
+
+            data = b''
+            while len(data) < 4 or len(data) < 4 + int.from_bytes(data[:4], 'big'):
+                data += conn.recv(1024)
+            req = BinaryCodec.loads(data[4:])
+            conn.sendall(BinaryCodec.frame(BinaryCodec.dumps({
+                'id': req['id'], 'jsonrpc': '2.0', 'result': 3
+            })))
+
+            self.assertEqual(req['method'], 'add')
+            self.assertEqual(future.result(), 3)
+        client.close()
+        conn.close()
+
+    def testFallback(self):
+        """Client must keep JSON when the server does not know rpc.negotiate."""
+        client, conn = self.connect({'error': {'code': -32601, 'message': 'Method not found'}})
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            future = executor.submit(client.hello)
+
+            req = json.loads(recv_line(conn))
+            conn.sendall(json.dumps({
+                'id': req['id'], 'jsonrpc': '2.0', 'result': 'Ok'
+            }).encode() + b'\n')
+
+            self.assertEqual(future.result(), 'Ok')
+        client.close()
+        conn.close()
+
+
+class TestStream(TestBase):
+    """Tests streamed results."""
+
+    def testInvokeStream(self):
+        """Client must yield the items of every partial response."""
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            future = executor.submit(lambda: list(self.client.invoke_stream('numbers', [4])))
+
+            req = self.recv_json()
+            self.send_json({'id': req['id'], 'jsonrpc': '2.0', 'partial': [0, 1]})
+            self.send_json({'id': req['id'], 'jsonrpc': '2.0', 'partial': [2, 3]})
+            self.send_json({'id': req['id'], 'jsonrpc': '2.0', 'result': 4, 'done': True})
+
+            self.assertTrue(req['stream'])
+            self.assertEqual(future.result(), [0, 1, 2, 3])
+
+    def testNotStreamed(self):
+        """A plain response must be iterated like a stream."""
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            future = executor.submit(lambda: list(self.client.invoke_stream('numbers', [2])))
+
+            req = self.recv_json()
+            self.jsonrpc_res(req['id'], result=[0, 1])
+            self.assertEqual(future.result(), [0, 1])
+
+    def testAbandoned(self):
+        """The rest of a stream that is not read must be skipped."""
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            def first():
+                items = self.client.invoke_stream('numbers', [4])
+                item = next(items)
+                items.close()
+                return item
+            future = executor.submit(first)
+
+            req = self.recv_json()
+            self.send_json({'id': req['id'], 'jsonrpc': '2.0', 'partial': [0, 1]})
+            self.send_json({'id': req['id'], 'jsonrpc': '2.0', 'partial': [2, 3]})
+            self.send_json({'id': req['id'], 'jsonrpc': '2.0', 'result': 4, 'done': True})
+            self.assertEqual(future.result(), 0)
+
+            future = executor.submit(self.client.hello)
+            req = self.recv_json()
+            self.jsonrpc_res(req['id'], result='Ok')
+            self.assertEqual(future.result(), 'Ok')
+
+
+class TestPool(TestBase):
+    """Tests the connection pool."""
+
+    def setUp(self):
+        super().setUp()
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            future = executor.submit(JSONRPCClientPool, SERVER_HOST, SERVER_PORT, 1, 2, 0)
+            self.pool_conn, _ = self.sock.accept()
+            self.pool = future.result()
+
+    def tearDown(self):
+        self.pool.close()
+        self.pool_conn.close()
+        super().tearDown()
+
+    def answer(self, conn, result):
+        """Answers the next request of a connection."""
+        req = json.loads(recv_line(conn))
+        conn.sendall(json.dumps({
+            'id': req['id'], 'jsonrpc': '2.0', 'result': result
+        }).encode() + b'\n')
+
+    def testReuseConnection(self):
+        """Connections must be reused between calls."""
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            for _ in range(3):
+                future = executor.submit(self.pool.hello)
+                self.answer(self.pool_conn, 'Ok')
+                self.assertEqual(future.result(), 'Ok')
+        self.assertEqual(self.pool.stats()['size'], 1)
+
+    def testWaitMetrics(self):
+        """Waiting for a connection must be measured."""
+        first = self.pool.acquire()
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            connect = executor.submit(self.pool.acquire)
+            conn, _ = self.sock.accept()
+            second = connect.result()
+
+            # The pool is full, the next caller waits for a release
+            future = executor.submit(self.pool.acquire)
+            time.sleep(0.1)
+            self.pool.release(first)
+            self.assertIs(future.result(), first)
+
+        self.pool.release(first)
+        self.pool.release(second)
+        conn.close()
+
+        stats = self.pool.stats()
+        self.assertEqual(stats['waits'], 1)
+        self.assertGreaterEqual(stats['wait_max'], 0.1)
+        self.assertEqual(stats['size'], 2)
+
+    def testAcquireTimeout(self):
+        """Acquiring from a full pool must time out."""
+        first = self.pool.acquire()
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            connect = executor.submit(self.pool.acquire)
+            conn, _ = self.sock.accept()
+            second = connect.result()
+
+        self.assertRaises(TimeoutError, self.pool.acquire, 0.05)
+        self.pool.release(first)
+        self.pool.release(second)
+        conn.close()
+
+    def testReconnect(self):
+        """Closed idle connections must be replaced."""
+        self.pool_conn.close()
+        time.sleep(0.05)
+
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            future = executor.submit(self.pool.hello)
+            self.pool_conn, _ = self.sock.accept()
+            self.answer(self.pool_conn, 'Ok')
+            self.assertEqual(future.result(), 'Ok')
+        self.assertEqual(self.pool.stats()['reconnects'], 1)
+
+
+class TestSharedClient(TestBase):
+    """Tests a JSONRPCClient shared by several threads."""
+
+    def testConcurrentCalls(self):
+        """Each thread must get the response to its own request."""
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            futures = [executor.submit(self.client.echo, num) for num in range(5)]
+            for _ in range(5):
+                req = json.loads(recv_line(self.conn))
+                self.jsonrpc_res(req['id'], result=req['params'][0])
+
+            self.assertEqual([future.result() for future in futures], list(range(5)))
+
+
+def recv_line(conn):
+    """Receives a newline-delimited message from a socket."""
+    res = b''
+    while not res.endswith(b'\n'):
+        data = conn.recv(1024)
+        if not data:
+            break
+        res += data
+    return res.decode()
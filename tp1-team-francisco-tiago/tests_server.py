@@ -4,7 +4,9 @@
 """
 
 import json
+import os
 import random
+import signal
 import socket
 import string
 import time
@@ -12,20 +14,42 @@ import threading
 import unittest
 
 import functions
+import loadgen
+from cache import LRU
+from codec import BinaryCodec
 from server import JSONRPCServer
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 # Define server host and port
 SERVER_HOST = '127.0.0.1'
 SERVER_PORT = 8000
 
 
+def recv_line(sock):
+    """Receives a newline-delimited message from a socket."""
+    res = b''
+    while not res.endswith(b'\n'):
+        data = sock.recv(1024)
+        if not data:
+            break
+        res += data
+    return res.decode()
+
+
 class TestBase(unittest.TestCase):
     """Base for all tests."""
 
+    # Extra arguments for the server
+    server_options = {}
+
     def setUp(self):
         # Initiate the server
-        self.server = JSONRPCServer(SERVER_HOST, SERVER_PORT)
+        self.server = JSONRPCServer(SERVER_HOST, SERVER_PORT, **self.server_options)
 
         # Register functions
         self.server.register('hello', functions.hello)
@@ -40,7 +64,7 @@ class TestBase(unittest.TestCase):
         self.server_thread.start()
 
         # Starts the client
-        time.sleep(0.001)
+        self.server.ready.wait(1)
         self.sock = socket.socket()
         self.sock.connect((SERVER_HOST, SERVER_PORT))
 
@@ -51,9 +75,8 @@ class TestBase(unittest.TestCase):
 
     def send(self, msg):
         """Sends a message to the socket"""
-        self.sock.sendall(msg.encode())
-        res = self.sock.recv(1024).decode()
-        return res
+        self.sock.sendall(msg.encode() + b'\n')
+        return recv_line(self.sock)
 
     def send_json(self, payload):
         """Sends json message to the socket."""
@@ -232,7 +255,761 @@ class TestEdgeCases(TestBase):
             'method': 'greet',
         }
         msg = json.dumps(req)
-        self.sock.sendall(msg.encode())
+        self.sock.sendall(msg.encode() + b'\n')
+        time.sleep(0.1)
+
+        # The next response must belong to the next request
+        res = self.jsonrpc_req(2, 'hello', [])
+        self.assertEqual(res['id'], 2)
+
+
+class TestConcurrentClients(TestBase):
+    """Tests several clients connected at the same time."""
+
+    def testIdleClientDoesNotBlock(self):
+        """A client holding its connection open must not block others."""
+        # self.sock stays connected without sending anything
+        other = socket.socket()
+        other.settimeout(1)
+        other.connect((SERVER_HOST, SERVER_PORT))
+        other.sendall(json.dumps({
+            'id': 1,
+            'jsonrpc': '2.0',
+            'method': 'add',
+            'params': [4, 2]
+        }).encode() + b'\n')
+        res = json.loads(recv_line(other))
+        other.close()
+        self.assertEqual(res['result'], 6)
+
+    def testManyOpenConnections(self):
+        """Server must serve many simultaneous connections."""
+        clients = []
+        for _ in range(200):
+            client = socket.socket()
+            client.settimeout(1)
+            client.connect((SERVER_HOST, SERVER_PORT))
+            clients.append(client)
+
+        # Send the requests in reverse order of connection
+        for rpcid, client in reversed(list(enumerate(clients))):
+            client.sendall(json.dumps({
+                'id': rpcid,
+                'jsonrpc': '2.0',
+                'method': 'mul',
+                'params': [rpcid, 2]
+            }).encode() + b'\n')
+
+        for rpcid, client in enumerate(clients):
+            res = json.loads(recv_line(client))
+            client.close()
+            self.assertEqual(res['id'], rpcid)
+            self.assertEqual(res['result'], rpcid * 2)
+
+
+class TestPersistentConnections(TestBase):
+    """Tests framed requests over a single connection."""
+
+    def testSeveralRequests(self):
+        """A connection must serve several requests in sequence."""
+        for rpcid in range(1, 11):
+            res = self.jsonrpc_req(rpcid, 'add', [rpcid, 1])
+            self.assertEqual(res['id'], rpcid)
+            self.assertEqual(res['result'], rpcid + 1)
+
+    def testPipelinedRequests(self):
+        """Requests sent together must be answered in order."""
+        msg = b''
+        for rpcid in range(1, 4):
+            msg += json.dumps({
+                'id': rpcid,
+                'jsonrpc': '2.0',
+                'method': 'sub',
+                'params': [10, rpcid]
+            }).encode() + b'\n'
+        self.sock.sendall(msg)
+
+        res = b''
+        while res.count(b'\n') < 3:
+            res += self.sock.recv(1024)
+        for rpcid, line in enumerate(res.splitlines(), 1):
+            res = json.loads(line)
+            self.assertEqual(res['id'], rpcid)
+            self.assertEqual(res['result'], 10 - rpcid)
+
+    def testLargePayload(self):
+        """Messages larger than 1 KiB must not be truncated."""
+        name = 'x' * 100000
+        res = self.jsonrpc_req(1, 'greet', [name])
+        self.assertEqual(res['result'], 'Hello ' + name)
+
+
+class TestBatch(TestBase):
+    """Tests JSON-RPC batch requests."""
+
+    def testBatch(self):
+        """Server must answer every request of a batch in one array."""
+        res = self.send_json([
+            {'id': 1, 'jsonrpc': '2.0', 'method': 'add', 'params': [1, 2]},
+            {'id': 2, 'jsonrpc': '2.0', 'method': 'mul', 'params': [3, 4]},
+            {'id': 3, 'jsonrpc': '2.0', 'method': 'nofunc', 'params': []},
+            {'jsonrpc': '2.0', 'method': 'hello'},
+            1
+        ])
+        self.assertIsInstance(res, list)
+        self.assertEqual(len(res), 4)
+        res = {item['id']: item for item in res}
+        self.assertEqual(res[1]['result'], 3)
+        self.assertEqual(res[2]['result'], 12)
+        self.assertEqual(res[3]['error']['code'], -32601)
+        self.assertEqual(res['No ID']['error']['code'], -32600)
+
+    def testEmptyBatch(self):
+        """An empty batch is an invalid request."""
+        res = self.send_json([])
+        self.assertEqual(res['error']['code'], -32600)
+
+    def testNotificationsBatch(self):
+        """Server must not respond to a batch of notifications."""
+        msg = json.dumps([{'jsonrpc': '2.0', 'method': 'hello'}])
+        self.sock.sendall(msg.encode() + b'\n')
+
+        res = self.jsonrpc_req(2, 'hello', [])
+        self.assertEqual(res['id'], 2)
+
+
+class TestParallelBatch(TestBase):
+    """Tests batches dispatched on a worker pool."""
+
+    server_options = {'batch_workers': 8}
+
+    def testParallelBatch(self):
+        """Batch entries must run concurrently."""
+        self.server.register('wait', functions.wait)
+
+        reqs = [{'id': rpcid, 'jsonrpc': '2.0', 'method': 'wait', 'params': [0.2]}
+                for rpcid in range(8)]
+        start = time.monotonic()
+        res = self.send_json(reqs)
+        elapsed = time.monotonic() - start
+
+        self.assertEqual(sorted(item['id'] for item in res), list(range(8)))
+        self.assertLess(elapsed, 0.2 * 4)
+
+    def testErrorInBatch(self):
+        """A failing entry must not affect the others."""
+        res = self.send_json([
+            {'id': 1, 'jsonrpc': '2.0', 'method': 'div', 'params': [1, 0]},
+            {'id': 2, 'jsonrpc': '2.0', 'method': 'div', 'params': [4, 2]}
+        ])
+        res = {item['id']: item for item in res}
+        self.assertEqual(res[1]['error']['code'], -32603)
+        self.assertEqual(res[2]['result'], 2)
+
+
+class TestExecutors(TestBase):
+    """Tests functions registered on executors."""
+
+    def testThreadExecutor(self):
+        """Blocking functions must not stall the other clients."""
+        self.server.register('wait', functions.wait, executor='thread')
+
+        msg = json.dumps({'id': 1, 'jsonrpc': '2.0', 'method': 'wait', 'params': [0.5]})
+        self.sock.sendall(msg.encode() + b'\n')
+
+        # Another client is served while the first call is running
+        other = socket.socket()
+        other.settimeout(1)
+        other.connect((SERVER_HOST, SERVER_PORT))
+        start = time.monotonic()
+        other.sendall(json.dumps({
+            'id': 2, 'jsonrpc': '2.0', 'method': 'add', 'params': [1, 2]
+        }).encode() + b'\n')
+        res = json.loads(recv_line(other))
+        other.close()
+        self.assertEqual(res['result'], 3)
+        self.assertLess(time.monotonic() - start, 0.5)
+
+        res = json.loads(recv_line(self.sock))
+        self.assertEqual(res['result'], 0.5)
+
+    def testProcessExecutor(self):
+        """CPU-bound functions must run on the process executor."""
+        self.server.register('mul', functions.mul, executor='process')
+        res = self.jsonrpc_req(1, 'mul', [4, 2])
+        self.assertEqual(res['result'], 8)
+
+        res = self.jsonrpc_req(2, 'mul', [4])
+        self.assertEqual(res['error']['code'], -32602)
+
+    def testQueueLimit(self):
+        """Calls over the queue limit must be rejected."""
+        self.server.configure_executor('thread', workers=1, max_queue=1)
+        self.server.register('wait', functions.wait, executor='thread')
+
+        msg = b''
+        for rpcid in range(1, 3):
+            msg += json.dumps({
+                'id': rpcid, 'jsonrpc': '2.0', 'method': 'wait', 'params': [0.2]
+            }).encode() + b'\n'
+        self.sock.sendall(msg)
+
+        res = json.loads(recv_line(self.sock))
+        self.assertEqual(res['id'], 2)
+        self.assertEqual(res['error']['code'], -32000)
+
+        res = json.loads(recv_line(self.sock))
+        self.assertEqual(res['id'], 1)
+        self.assertEqual(res['result'], 0.2)
+
+    def testUnknownExecutor(self):
+        """Functions can only be registered on known executors."""
+        self.assertRaises(ValueError, self.server.register, 'add', functions.add, 'gpu')
+        self.assertRaises(ValueError, self.server.configure_executor, 'gpu')
+
+
+class TestCache(TestBase):
+    """Tests the result cache of pure functions."""
+
+    def setUp(self):
+        super().setUp()
+        self.calls = 0
+
+    def count(self, num):
+        """Counts the calls and returns the number."""
+        self.calls += 1
+        return num
+
+    def testCacheHit(self):
+        """Cached calls must not invoke the function."""
+        self.server.register('count', self.count, cache=LRU(10))
+        for rpcid in range(1, 4):
+            res = self.jsonrpc_req(rpcid, 'count', [7])
+            self.assertEqual(res['id'], rpcid)
+            self.assertEqual(res['result'], 7)
+
+        self.assertEqual(self.calls, 1)
+        stats = self.server.cache_stats()['count']
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 1)
+
+    def testCacheExpiry(self):
+        """Cached results must expire after the ttl."""
+        self.server.register('count', self.count, cache=LRU(10, ttl=0.05))
+        self.jsonrpc_req(1, 'count', [7])
         time.sleep(0.1)
-        res = self.sock.recv(1024).decode()
-        self.assertEqual(res, '')
+        self.jsonrpc_req(2, 'count', [7])
+
+        self.assertEqual(self.calls, 2)
+        self.assertEqual(self.server.cache_stats()['count']['expired'], 1)
+
+    def testCacheEviction(self):
+        """The least recently used result must be evicted."""
+        self.server.register('count', self.count, cache=LRU(2))
+        for rpcid, num in enumerate([1, 2, 1, 3, 1, 2], 1):
+            self.jsonrpc_req(rpcid, 'count', [num])
+
+        # 2 was evicted by 3, 1 was kept as the most recently used
+        self.assertEqual(self.calls, 4)
+        stats = self.server.cache_stats()['count']
+        self.assertEqual(stats['evictions'], 2)
+        self.assertEqual(stats['hits'], 2)
+
+    def testCacheErrors(self):
+        """Errors must not be cached."""
+        self.server.register('div', functions.div, cache=LRU(10))
+        self.jsonrpc_req(1, 'div', [1, 0])
+        res = self.jsonrpc_req(2, 'div', [1, 0])
+        self.assertEqual(res['error']['code'], -32603)
+        self.assertEqual(self.server.cache_stats()['div']['misses'], 2)
+
+    def testCollapsedCalls(self):
+        """Identical calls running at once must be computed once."""
+        def slow_count(num):
+            time.sleep(0.2)
+            return self.count(num)
+        self.server.register('count', slow_count, executor='thread', cache=LRU(10))
+
+        msg = b''
+        for rpcid in range(1, 4):
+            msg += json.dumps({
+                'id': rpcid, 'jsonrpc': '2.0', 'method': 'count', 'params': [7]
+            }).encode() + b'\n'
+        self.sock.sendall(msg)
+
+        res = b''
+        while res.count(b'\n') < 3:
+            res += self.sock.recv(1024)
+        res = [json.loads(line) for line in res.splitlines()]
+        self.assertEqual(sorted(item['id'] for item in res), [1, 2, 3])
+        self.assertEqual([item['result'] for item in res], [7, 7, 7])
+
+        self.assertEqual(self.calls, 1)
+        stats = self.server.cache_stats()['count']
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['collapsed'], 2)
+        self.assertEqual(stats['hits'], 0)
+
+
+class TestShutdown(TestBase):
+    """Tests stopping the server."""
+
+    def testStopTwice(self):
+        """Stopping a stopped server must be harmless."""
+        self.server.stop()
+        self.server_thread.join()
+        self.server.stop()
+
+    def testStopBeforeStart(self):
+        """A server may be stopped before it starts."""
+        server = JSONRPCServer(SERVER_HOST, SERVER_PORT + 1)
+        server.stop()
+        thread = threading.Thread(target=server.start)
+        thread.start()
+        thread.join(1)
+        self.assertFalse(thread.is_alive())
+
+    def testInFlightCalls(self):
+        """Calls in flight must be answered when the server stops."""
+        self.server.register('wait', functions.wait, executor='thread')
+        msg = json.dumps({'id': 1, 'jsonrpc': '2.0', 'method': 'wait', 'params': [0.2]})
+        self.sock.sendall(msg.encode() + b'\n')
+        time.sleep(0.05)
+
+        self.server.stop()
+        res = json.loads(recv_line(self.sock))
+        self.assertEqual(res['result'], 0.2)
+
+
+class TestMalformedFrames(TestBase):
+    """Tests frames that cannot be decoded."""
+
+    server_options = {'max_message': 1024}
+
+    def testInvalidUTF8(self):
+        """Invalid UTF-8 is a parse error and keeps the connection."""
+        self.sock.sendall(b'\xff\xfe\n' + json.dumps({
+            'id': 2, 'jsonrpc': '2.0', 'method': 'hello'
+        }).encode() + b'\n')
+
+        res = b''
+        while res.count(b'\n') < 2:
+            res += self.sock.recv(1024)
+        first, second = [json.loads(line) for line in res.splitlines()]
+        self.assertEqual(first['error']['code'], -32700)
+        self.assertEqual(second['result'], 'Hi!')
+
+    def testMessageTooLarge(self):
+        """Messages over the size limit are rejected."""
+        self.sock.sendall(b'x' * 4096)
+        res = json.loads(recv_line(self.sock))
+        self.assertEqual(res['error']['code'], -32600)
+        self.assertEqual(self.sock.recv(1024), b'')
+
+
+class TestUnserializableResults(TestBase):
+    """Tests results that cannot be encoded as JSON."""
+
+    server_options = {'batch_workers': 2}
+
+    def testInlineResult(self):
+        """The client must receive an internal error."""
+        self.server.register('obj', object)
+        res = self.jsonrpc_req(1, 'obj', [])
+        self.assertEqual(res['id'], 1)
+        self.assertEqual(res['error']['code'], -32603)
+
+    def testExecutorResult(self):
+        """Results computed on an executor must fail the same way."""
+        self.server.register('obj', object, executor='thread')
+        res = self.jsonrpc_req(1, 'obj', [])
+        self.assertEqual(res['id'], 1)
+        self.assertEqual(res['error']['code'], -32603)
+
+    def testBatchResult(self):
+        """Only the failing entry of a batch must be an error."""
+        self.server.register('obj', object)
+        res = self.send_json([
+            {'id': 1, 'jsonrpc': '2.0', 'method': 'obj', 'params': []},
+            {'id': 2, 'jsonrpc': '2.0', 'method': 'add', 'params': [1, 2]}
+        ])
+        res = {item['id']: item for item in res}
+        self.assertEqual(res[1]['error']['code'], -32603)
+        self.assertEqual(res[2]['result'], 3)
+
+
+class TestMap(TestBase):
+    """Tests the rpc.map method."""
+
+    def testMapRows(self):
+        """Function must be applied to every tuple."""
+        res = self.jsonrpc_req(1, 'rpc.map', ['add', [[1, 2], [3, 4], [5, 6]]])
+        self.assertEqual(res['result'], [3, 7, 11])
+
+    def testMapColumns(self):
+        """Columnar arguments must give the same results."""
+        res = self.jsonrpc_req(1, 'rpc.map', ['mul', [[1, 3, 5], [2, 4, 6]], True])
+        self.assertEqual(res['result'], [2, 12, 30])
+
+    def testMapNotElementwise(self):
+        """Functions that are not elementwise are called per tuple."""
+        res = self.jsonrpc_req(1, 'rpc.map', ['greet', [['bob'], ['ted']]])
+        self.assertEqual(res['result'], ['Hello bob', 'Hello ted'])
+
+    def testMapEmpty(self):
+        """An empty list of tuples gives an empty result."""
+        res = self.jsonrpc_req(1, 'rpc.map', ['add', []])
+        self.assertEqual(res['result'], [])
+
+    def testMapErrors(self):
+        """Errors must be reported like in plain calls."""
+        res = self.jsonrpc_req(1, 'rpc.map', ['nofunc', [[1, 2]]])
+        self.assertEqual(res['error']['code'], -32601)
+
+        res = self.jsonrpc_req(2, 'rpc.map', ['add', [[1, 2], [3]]])
+        self.assertEqual(res['error']['code'], -32602)
+
+        res = self.jsonrpc_req(3, 'rpc.map', ['div', [[1, 2], [1, 0]]])
+        self.assertEqual(res['error']['code'], -32603)
+
+    @unittest.skipIf(numpy is None, 'NumPy is not installed')
+    def testMapVectorized(self):
+        """Elementwise functions must use the NumPy fast path."""
+        def double(a):
+            if not isinstance(a, numpy.ndarray):
+                raise AssertionError('not vectorized')
+            return a * 2
+        double.elementwise = True
+        self.server.register('double', double)
+
+        res = self.jsonrpc_req(1, 'rpc.map', ['double', [[1], [2], [3]]])
+        self.assertEqual(res['result'], [2, 4, 6])
+
+
+class TestCodec(TestBase):
+    """Tests the binary codec."""
+
+    def testRoundTrip(self):
+        """Values must be decoded as they were encoded."""
+        for value in [None, True, False, -7, 2 ** 70, 1.5, 'olá', [1, 2, 3],
+                      [0.5, 1.5], [1, 'a', None], {'a': [{'b': 2}], 'c': []}]:
+            self.assertEqual(BinaryCodec.loads(BinaryCodec.dumps(value)), value)
+
+    def testInvalidMessage(self):
+        """Truncated messages cannot be decoded."""
+        with self.assertRaises(ValueError):
+            BinaryCodec.loads(BinaryCodec.dumps([1, 2, 3])[:-1])
+
+    def testNegotiate(self):
+        """The connection must switch to the codec after the answer."""
+        res = self.jsonrpc_req(1, 'rpc.negotiate', ['msgpack', 'binary'])
+        self.assertEqual(res['result'], 'binary')
+
+        self.sock.sendall(BinaryCodec.frame(BinaryCodec.dumps({
+            'id': 2, 'jsonrpc': '2.0', 'method': 'add', 'params': [1, 2]
+        })))
+        res = b''
+        while len(res) < 4 or len(res) < 4 + int.from_bytes(res[:4], 'big'):
+            res += self.sock.recv(1024)
+        res = BinaryCodec.loads(res[4:])
+        self.assertEqual(res['id'], 2)
+        self.assertEqual(res['result'], 3)
+
+    def testNegotiateUnknown(self):
+        """Connections must keep JSON when no codec is known."""
+        res = self.jsonrpc_req(1, 'rpc.negotiate', ['msgpack'])
+        self.assertEqual(res['result'], 'json')
+
+        res = self.jsonrpc_req(2, 'hello', [])
+        self.assertEqual(res['result'], 'Hi!')
+
+
+def setup_worker(server):
+    """Registers the functions of the pre-fork tests in a worker."""
+    server.register('pid', os.getpid)
+    server.register('wait', functions.wait, executor='thread')
+
+
+class TestPreFork(unittest.TestCase):
+    """Tests the pre-fork server."""
+
+    # Extra arguments for serve_forever
+    serve_options = {}
+
+    def setUp(self):
+        self.server = JSONRPCServer(SERVER_HOST, SERVER_PORT + 2, verbose=False)
+        self.server.register('hello', functions.hello)
+        self.server_thread = threading.Thread(
+            target=self.server.serve_forever,
+            kwargs=dict(workers=2, setup=setup_worker, **self.serve_options))
+        self.server_thread.start()
+        self.server.ready.wait(1)
+
+    def tearDown(self):
+        self.server.stop()
+        self.server_thread.join()
+
+    def call(self, method, params, rpcid=1):
+        """Makes a call on a new connection."""
+        for _ in range(100):
+            try:
+                sock = socket.create_connection((SERVER_HOST, SERVER_PORT + 2))
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.01)
+        with sock:
+            sock.sendall(json.dumps({
+                'id': rpcid, 'jsonrpc': '2.0', 'method': method, 'params': params
+            }).encode() + b'\n')
+            return json.loads(recv_line(sock))
+
+    def testWorkers(self):
+        """Calls must be answered by the workers, after their setup."""
+        self.assertEqual(self.call('hello', [])['result'], 'Hi!')
+        pid = self.call('pid', [])['result']
+        self.assertIn(pid, self.server.workers)
+        self.assertNotEqual(pid, os.getpid())
+
+    def testRestart(self):
+        """A worker that crashes must be replaced."""
+        pids = set(self.server.workers)
+        os.kill(next(iter(pids)), signal.SIGKILL)
+
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            workers = set(self.server.workers)
+            if len(workers) == 2 and workers != pids:
+                break
+            time.sleep(0.05)
+        self.assertEqual(len(workers - pids), 1)
+        self.assertEqual(self.call('hello', [])['result'], 'Hi!')
+
+    def testGracefulStop(self):
+        """Calls in flight must be answered when the server stops."""
+        sock = socket.create_connection((SERVER_HOST, SERVER_PORT + 2))
+        with sock:
+            sock.sendall(json.dumps({
+                'id': 1, 'jsonrpc': '2.0', 'method': 'wait', 'params': [0.2]
+            }).encode() + b'\n')
+            time.sleep(0.1)
+
+            self.server.stop()
+            res = json.loads(recv_line(sock))
+            self.assertEqual(res['result'], 0.2)
+        self.server_thread.join(5)
+        self.assertFalse(self.server.workers)
+
+
+class TestReusePort(TestPreFork):
+    """Tests the pre-fork server with a socket per worker."""
+
+    serve_options = {'reuse_port': True}
+
+
+class TestStream(TestBase):
+    """Tests streamed results."""
+
+    def stream(self, method, params):
+        """Makes a streamed call and returns every frame of the answer."""
+        self.sock.sendall(json.dumps({
+            'id': 1, 'jsonrpc': '2.0', 'method': method, 'params': params, 'stream': True
+        }).encode() + b'\n')
+
+        frames = []
+        data = b''
+        while not frames or 'partial' in frames[-1]:
+            while b'\n' not in data:
+                data += self.sock.recv(65536)
+            line, data = data.split(b'\n', 1)
+            frames.append(json.loads(line))
+        return frames
+
+    def testInline(self):
+        """Generator results must come in partial responses."""
+        self.server.register('numbers', functions.numbers)
+        frames = self.stream('numbers', [200])
+
+        items = [item for frame in frames[:-1] for item in frame['partial']]
+        self.assertEqual(items, list(range(200)))
+        self.assertTrue(all(frame['id'] == 1 for frame in frames))
+        self.assertEqual(frames[-1]['result'], 200)
+        self.assertTrue(frames[-1]['done'])
+
+    def testExecutor(self):
+        """Generators running on a thread must be streamed too."""
+        self.server.register('numbers', functions.numbers, executor='thread')
+        frames = self.stream('numbers', [100])
+
+        items = [item for frame in frames[:-1] for item in frame['partial']]
+        self.assertEqual(items, list(range(100)))
+        self.assertEqual(frames[-1]['result'], 100)
+
+    def testNotStreamed(self):
+        """Callers that do not ask for a stream must get a list."""
+        self.server.register('numbers', functions.numbers)
+        res = self.jsonrpc_req(1, 'numbers', [3])
+        self.assertEqual(res['result'], [0, 1, 2])
+
+    def testError(self):
+        """An error while streaming must end the stream."""
+        def broken():
+            yield 1
+            raise ValueError
+        self.server.register('broken', broken)
+        frames = self.stream('broken', [])
+
+        self.assertEqual(frames[-1]['error']['code'], -32603)
+        self.assertTrue(frames[-1]['done'])
+
+
+class TestStats(TestBase):
+    """Tests the call statistics."""
+
+    def testCounts(self):
+        """Calls must be counted per method and errors per code."""
+        self.jsonrpc_req(1, 'add', [1, 2])
+        self.jsonrpc_req(2, 'add', [1, 2])
+        self.jsonrpc_req(3, 'div', [1, 0])
+        self.jsonrpc_req(4, 'nofunc', [])
+        self.send('{')
+
+        stats = self.jsonrpc_req(5, 'rpc.stats', [])['result']
+        self.assertEqual(stats['calls'], {'add': 2, 'div': 1})
+        self.assertEqual(stats['errors'], {'-32603': 1, '-32601': 1, '-32700': 1})
+
+    def testHistograms(self):
+        """Every call must be measured."""
+        self.jsonrpc_req(1, 'add', [1, 2])
+        self.server.register('wait', functions.wait, executor='thread')
+        self.jsonrpc_req(2, 'wait', [0.01])
+
+        stats = self.jsonrpc_req(3, 'rpc.stats', [])['result']
+        self.assertEqual(stats['dispatch']['add']['count'], 1)
+        self.assertGreaterEqual(stats['dispatch']['wait']['sum'], 0.01)
+        self.assertEqual(stats['decode']['count'], 3)
+        self.assertEqual(stats['encode']['count'], 2)
+
+    def testPrometheus(self):
+        """Statistics must be available as Prometheus text."""
+        self.jsonrpc_req(1, 'add', [1, 2])
+        text = self.jsonrpc_req(2, 'rpc.stats', ['prometheus'])['result']
+
+        self.assertIn('rpc_calls_total{method="add"} 1\n', text)
+        self.assertIn('rpc_dispatch_seconds_bucket{method="add",le="+Inf"} 1\n', text)
+        self.assertIn('rpc_dispatch_seconds_count{method="add"} 1\n', text)
+
+        res = self.jsonrpc_req(3, 'rpc.stats', ['xml'])
+        self.assertEqual(res['error']['code'], -32602)
+
+
+class TestStatsDisabled(TestBase):
+    """Tests a server without statistics."""
+
+    server_options = {'stats': False}
+
+    def testDisabled(self):
+        """rpc.stats must not exist."""
+        self.assertEqual(self.jsonrpc_req(1, 'add', [1, 2])['result'], 3)
+        res = self.jsonrpc_req(2, 'rpc.stats', [])
+        self.assertEqual(res['error']['code'], -32601)
+
+
+class TestLoadGen(unittest.TestCase):
+    """Tests the load generator."""
+
+    def testModes(self):
+        """Every mode must answer every call."""
+        results = loadgen.run_load({'add': 2, 'greet': 1}, calls=60, concurrency=3)
+        self.assertEqual([result['mode'] for result in results], list(loadgen.MODES))
+        for result in results:
+            self.assertEqual(result['calls'], 60)
+            self.assertEqual(result['errors'], 0)
+            self.assertLessEqual(result['p50_ms'], result['p99_ms'])
+
+
+class TestNotifications(TestBase):
+    """Tests the notification queue."""
+
+    def setUp(self):
+        super().setUp()
+        self.calls = []
+        self.server.register('record', self.calls.append)
+
+    def notify(self, count, method='record'):
+        """Sends notifications in a single message, then waits for a call."""
+        msg = b''.join(json.dumps({
+            'jsonrpc': '2.0', 'method': method, 'params': [num]
+        }).encode() + b'\n' for num in range(count))
+        self.sock.sendall(msg + json.dumps({
+            'id': 1, 'jsonrpc': '2.0', 'method': 'hello', 'params': []
+        }).encode() + b'\n')
+        self.assertEqual(json.loads(recv_line(self.sock))['result'], 'Hi!')
+
+    def wait_calls(self, count):
+        """Waits for the notifications to run."""
+        deadline = time.monotonic() + 2
+        while len(self.calls) < count and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def testRun(self):
+        """Notifications must run, without a response."""
+        self.notify(3)
+        self.wait_calls(3)
+        self.assertEqual(self.calls, [0, 1, 2])
+        self.assertEqual(self.server.notification_stats()['done'], 3)
+
+    def testUnknownMethod(self):
+        """Notifications of unknown methods are ignored."""
+        self.notify(1, 'nofunc')
+        self.assertEqual(self.server.notification_stats()['done'], 0)
+
+
+class TestNotificationPolicies(TestBase):
+    """Tests the notification queue when it is full."""
+
+    def start_queue(self, policy):
+        """Restarts the server with a notification queue of one."""
+        self.server.stop()
+        self.server_thread.join()
+        self.sock.close()
+        self.server.configure_notifications(max_queue=1, policy=policy)
+        self.calls = []
+        self.server.register('record', self.calls.append)
+
+        self.server_thread = threading.Thread(target=self.server.start)
+        self.server_thread.start()
+        self.server.ready.wait(1)
+        self.sock = socket.socket()
+        self.sock.connect((SERVER_HOST, SERVER_PORT))
+
+    notify = TestNotifications.notify
+    wait_calls = TestNotifications.wait_calls
+
+    def testDrop(self):
+        """New notifications must be dropped."""
+        self.start_queue('drop')
+        self.notify(5)
+        self.wait_calls(1)
+        self.assertEqual(self.calls, [0])
+        self.assertEqual(self.server.notification_stats()['dropped'], 4)
+
+    def testShedOldest(self):
+        """The oldest notifications must be dropped."""
+        self.start_queue('shed-oldest')
+        self.notify(5)
+        self.wait_calls(1)
+        self.assertEqual(self.calls, [4])
+        self.assertEqual(self.server.notification_stats()['shed'], 4)
+
+    def testBlock(self):
+        """Every notification must run, in order."""
+        self.start_queue('block')
+        self.notify(5)
+        self.wait_calls(5)
+        self.assertEqual(self.calls, [0, 1, 2, 3, 4])
+        self.assertEqual(self.server.notification_stats()['blocked'], 4)
+
+    def testUnknownPolicy(self):
+        """Policies must be known."""
+        with self.assertRaises(ValueError):
+            self.server.configure_notifications(policy='lifo')
@@ -0,0 +1,168 @@
+"""
+ Addresses and the in-process transport of the JSON-RPC server
+
+ A host may be a TCP host name, 'unix:///path/to/socket' for a Unix
+ domain socket, or 'inproc://name' for a server running in the same
+ process. The port is ignored for the last two.
+
+"""
+
+import asyncio
+import queue
+import socket
+
+
+UNIX = 'unix://'
+INPROC = 'inproc://'
+
+# Servers started on an inproc:// host, by name
+LOCAL_SERVERS = {}
+
+
+def unix_path(host):
+    """Returns the socket path of a unix:// host, or None."""
+    if isinstance(host, str) and host.startswith(UNIX):
+        return host[len(UNIX):]
+    return None
+
+
+def local_name(host):
+    """Returns the name of an inproc:// host, or None."""
+    if isinstance(host, str) and host.startswith(INPROC):
+        return host[len(INPROC):]
+    return None
+
+
+def connect(host, port):
+    """Opens a connection to a server, returns a socket or a socket-like object."""
+    name = local_name(host)
+    if name is not None:
+        try:
+            server = LOCAL_SERVERS[name]
+        except KeyError:
+            raise ConnectionRefusedError('No server at %s' % host) from None
+        return server.connect_local()
+
+    path = unix_path(host)
+    if path is not None:
+        sock = socket.socket(socket.AF_UNIX)
+        address = path
+    else:
+        sock = socket.socket()
+        address = (host, port)
+    try:
+        sock.connect(address)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+class InProcessTransport(asyncio.Transport):
+    """Server side of an in-process connection, used by the protocol in the event loop."""
+
+    def __init__(self, loop, sock):
+        super().__init__()
+        self.loop = loop
+        self.sock = sock
+        self.protocol = None
+        self.closing = False
+        self.paused = False
+        self.pending = []
+
+    def attach(self, protocol):
+        """Connects the protocol of the server."""
+        self.protocol = protocol
+        protocol.connection_made(self)
+
+    def feed(self, data):
+        """Passes data sent by the client to the protocol."""
+        if self.closing:
+            return
+        if self.paused:
+            self.pending.append(data)
+        else:
+            self.protocol.data_received(data)
+
+    def write(self, data):
+        self.sock.incoming.put(bytes(data))
+
+    def is_closing(self):
+        return self.closing
+
+    def close(self):
+        if self.closing:
+            return
+        self.closing = True
+        self.sock.incoming.put(b'')
+        self.loop.call_soon(self.protocol.connection_lost, None)
+
+    def pause_reading(self):
+        self.paused = True
+
+    def resume_reading(self):
+        self.paused = False
+        while self.pending and not self.paused and not self.closing:
+            self.protocol.data_received(self.pending.pop(0))
+
+    def is_reading(self):
+        return not self.paused and not self.closing
+
+    def get_extra_info(self, name, default=None):
+        return default
+
+
+class InProcessSocket:
+    """
+    Client side of an in-process connection.
+
+    Behaves like the blocking socket of a client. Sent data is handed to
+    the event loop of the server and its answers are read from a queue,
+    without going through the kernel.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.incoming = queue.Queue()
+        self.transport = InProcessTransport(loop, self)
+        self.buffer = b''
+        self.blocking = True
+        self.closed = False
+
+    def sendall(self, data):
+        """Sends data to the server."""
+        if self.closed or self.transport.closing:
+            raise ConnectionError('Connection closed')
+        try:
+            self.loop.call_soon_threadsafe(self.transport.feed, bytes(data))
+        except RuntimeError:
+            raise ConnectionError('Connection closed by the server') from None
+
+    def recv(self, size, flags=0):
+        """Receives data from the server, b'' once it closed the connection."""
+        if not self.buffer:
+            try:
+                self.buffer = self.incoming.get(self.blocking)
+            except queue.Empty:
+                raise BlockingIOError from None
+            if not self.buffer:
+                # Keep reporting the end of the connection
+                self.incoming.put(b'')
+        data = self.buffer[:size]
+        if not flags & socket.MSG_PEEK:
+            self.buffer = self.buffer[size:]
+        return data
+
+    def setblocking(self, flag):
+        self.blocking = flag
+
+    def close(self):
+        """Closes the connection."""
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.loop.call_soon_threadsafe(self.transport.close)
+        except RuntimeError:
+            # The event loop of the server is closed
+            pass